@@ -1,21 +1,36 @@
+import time
+_import_start = time.perf_counter()
+
+import os
+import logging
+import importlib
+import threading
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
-import numpy as np
-import plotly.graph_objects as go
-from dash.dependencies import Input, Output
-from datetime import datetime
-from visualization import alarm_visualization
-
-from database import fetch_all_dis_as_df, fetch_all_wea_as_df
-from visualization import map_plot
+from dash.dependencies import Input, Output, State
+from visualization import alarm_visualization, disaster_visualization, map_viewport
+from figures import get_figure, load_figures, disaster_key, alarm_key
+from database import get_client
+from models import preload
+import metrics
+import utils
 
 # Definitions of constants. This projects uses extra CSS stylesheet at `./assets/style.css`
 COLORS = ['rgb(67,67,67)', 'rgb(115,115,115)', 'rgb(49,130,189)', 'rgb(189,189,189)']
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css', '/assets/style.css']
+IMPORT_BUDGET = 1.0                 # seconds importing this module may take before a warning
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'app.log')
+
+ready = threading.Event()           # set once the worker has warmed up, see `warmup`
+_warmup_pid = None
+_warmup_lock = threading.Lock()
 
 # Define the dash app first
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+server = app.server                 # WSGI entry point, e.g. `gunicorn -w 4 app:server`
 
 
 # Define component functions
@@ -100,7 +115,8 @@ def disaster_visualization_tool():
                             value='Wildfires',
                             style={'paddingLeft': '0px'})
                             ], className='two columns', style={'marginLeft': 0, 'marginTop': '10%'}),
-            html.Div(children=[dcc.Graph(id='disaster-figure')], className='ten columns')
+            html.Div(children=[dcc.Graph(id='disaster-figure'),
+                               dcc.Store(id='map-view', data=None)], className='ten columns')
             ], className='row twelve columns', style={'marginBottom': '5%', 'marginTop': '1%'})
         ], className='row twelve columns')
 
@@ -195,16 +211,34 @@ app.layout = html.Div([
 
 
 
+@app.callback(
+    Output('map-view', 'data'),
+    [Input('disaster-figure', 'relayoutData')],
+    [State('map-view', 'data')])
+def map_view_handler(relayout, current):
+    """Tracks the viewport of the disaster map (None for the world view), see `map_viewport`;
+    relayouts that do not move the map, such as autosize, change nothing
+    """
+    if 'mapbox.zoom' not in (relayout or {}):
+        return dash.no_update
+    view = map_viewport(relayout)
+    return dash.no_update if view == current else view
+
+
 @app.callback(
     Output('disaster-figure', 'figure'),
     [Input('status-checkbox', 'value'),
-     Input('disaster-click', 'value')])
-def disaster_visual_handler(status, disaster):
-    """Changes the display graph of supply-demand"""
-    df = fetch_all_dis_as_df(allow_cached=True)
-    if df is None:
-        return go.Figure()
-    return map_plot(df[(df['title'] == disaster) & df['status'].isin(status)])
+     Input('disaster-click', 'value'),
+     Input('map-view', 'data')])
+@metrics.timed('disaster_callback')
+def disaster_visual_handler(status, disaster, view):
+    """Changes the display graph of supply-demand: the precomputed world map, or the map of
+    the current viewport once the user zoomed in
+    """
+    if view is not None:
+        metrics.inc('figure_viewport')
+        return disaster_visualization(status, disaster, viewport=view)
+    return get_figure(disaster_key(status, disaster), lambda: disaster_visualization(status, disaster))
 
 _alarm_data_cache = None
 
@@ -213,11 +247,57 @@ _alarm_data_cache = None
     Output('alarm-figure', 'figure'),
     [Input('city-click', 'value'),
      Input('alarm-rate-slider', 'value')])
+@metrics.timed('alarm_callback')
 def alarm_handler(city, rate):
     """Changes the display graph of supply-demand"""
-    return alarm_visualization(city, rate)
+    return get_figure(alarm_key(city, rate), lambda: alarm_visualization(city, rate))
 
 
+def warmup():
+    """Loads what the first callbacks would otherwise wait for: the MongoDB connection, the
+    precomputed figures, the alarm models and scikit-learn, then sets `ready`. A failed step is
+    logged and skipped, since the callbacks load everything lazily anyway.
+    """
+    start = time.perf_counter()
+    steps = [('mongo', lambda: get_client().admin.command('ping')), ('figures', load_figures),
+             ('models', preload), ('sklearn', lambda: importlib.import_module('sklearn.neighbors'))]
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            logger.warning("warmup step {} failed: {}".format(name, e))
+    elapsed = time.perf_counter() - start
+    metrics.observe('warmup', elapsed)
+    logger.info("ready after {:.2f}s of warmup".format(elapsed))
+    ready.set()
+
+
+@server.before_request
+def start_warmup():
+    """Runs `warmup` in a background thread, once per process (threads do not survive a fork)"""
+    global _warmup_pid
+    with _warmup_lock:
+        if _warmup_pid != os.getpid():
+            _warmup_pid = os.getpid()
+            ready.clear()
+            threading.Thread(target=warmup, daemon=True).start()
+
+
+@server.route('/ready')
+def ready_endpoint():
+    """Readiness probe: 200 once this worker has warmed up, 503 before"""
+    return ('ready', 200) if ready.is_set() else ('warming up', 503)
+
+
+@server.route('/metrics')
+def metrics_endpoint():
+    """Exposes the metrics of this worker in the Prometheus text format"""
+    return flask.Response(metrics.export_text(), mimetype='text/plain; version=0.0.4')
+
+
+start_warmup()
+metrics.observe('import_app', utils.log_import_time(logger, __name__, _import_start, IMPORT_BUDGET))
+
 if __name__ == '__main__':
     app.run_server(debug=True, port=1050, host='0.0.0.0')
 
@@ -0,0 +1,257 @@
+"""
+Benchmarks of the ingestion, query and dashboard hot paths against synthetic data.
+
+Runs against a local stub HTTP server for the upstream APIs and either a scratch MongoDB given
+with `--mongo-uri`, in which database `disaster_bench` is used and dropped, or mongomock. mongomock
+is not in `requirements.txt` and lags behind pymongo (mongomock 4.3 cannot run the bulk upserts of
+pymongo 4.9 and later), so without `--mongo-uri` the run stops early when it is missing or
+incompatible. Results are printed, and written as JSON with `--out`, e.g.
+
+    python benchmark.py --mongo-uri mongodb://localhost:27017 --scale 10000 --repeat 3 --out bench.json
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import time
+import platform
+import argparse
+import statistics
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+BENCH_DB = 'disaster_bench'
+EONET_TITLES = ["Wildfires", "Severe Storms", "Sea and Lake Ice", "Volcanoes"]
+
+
+def make_eonet_payload(n_geometries, geometries_per_event=5, polygon_ratio=0.05, seed=0):
+    """Returns a synthetic EONET events payload with about `n_geometries` geometries over the last
+    365 days, spread over the three tracked categories and one ignored category.
+    """
+    rng = np.random.default_rng(seed)
+    now = datetime.utcnow()
+    events = []
+    for i in range(max(1, n_geometries // geometries_per_event)):
+        title = EONET_TITLES[i % len(EONET_TITLES)]
+        start = now - timedelta(days=float(rng.uniform(0, 365)))
+        lon, lat = float(rng.uniform(-125, -65)), float(rng.uniform(25, 50))
+        geometries = []
+        for j in range(geometries_per_event):
+            date = (start + timedelta(hours=6 * j)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            lon, lat = lon + float(rng.normal(0, 0.1)), lat + float(rng.normal(0, 0.1))
+            if rng.random() < polygon_ratio:
+                ring = [[lon + dx, lat + dy] for dx, dy in [(0, 0), (0.2, 0), (0.2, 0.2), (0, 0.2), (0, 0)]]
+                geometries.append({'date': date, 'type': 'Polygon', 'coordinates': [ring]})
+            else:
+                geometries.append({'date': date, 'type': 'Point', 'coordinates': [lon, lat]})
+        events.append({'id': 'EONET_{}'.format(i), 'title': '{} {}'.format(title, i),
+                       'description': '', 'link': '', 'categories': [{'id': i % 20, 'title': title}],
+                       'sources': [{'id': 'InciWeb', 'url': 'https://example.org/{}'.format(i)}],
+                       'geometries': geometries})
+    return {'title': 'EONET Events', 'description': 'Natural events from EONET.', 'events': events}
+
+
+def make_weather_record(ts, seed=0):
+    """Returns one synthetic Dark Sky daily record for unix time `ts`"""
+    rng = np.random.default_rng(seed + ts)
+    high = float(rng.uniform(40, 100))
+    record = {'time': ts, 'summary': 'Clear', 'icon': 'clear-day', 'precipProbability': 0.1,
+              'sunriseTime': ts + 25000, 'temperatureHighTime': ts + 50000,
+              'uvIndex': int(rng.integers(0, 11)), 'windBearing': int(rng.integers(0, 360))}
+    for name in ['temperatureHigh', 'temperatureMax', 'apparentTemperatureHigh', 'apparentTemperatureMax']:
+        record[name] = round(high, 2)
+    for name in ['temperatureLow', 'temperatureMin', 'apparentTemperatureLow', 'apparentTemperatureMin']:
+        record[name] = round(high - 20, 2)
+    record.update(cloudCover=round(float(rng.random()), 2), dewPoint=round(high - 25, 2),
+                  humidity=round(float(rng.random()), 2), moonPhase=round(float(rng.random()), 2),
+                  ozone=300.0, pressure=1015.0, visibility=10.0, windGust=7.0, windSpeed=3.0)
+    return record
+
+
+def make_weather_history(locations, days=30):
+    """Returns the {(lat, lon): records} dict `fetch_weather_days` produces for `days` days"""
+    now = int(time.time())
+    return {loc: [make_weather_record(now - 86400 * d) for d in range(days)] for loc in locations}
+
+
+def start_stub_server(eonet_payload):
+    """Starts a local HTTP server answering EONET requests under `/events` with `eonet_payload`
+    and Dark Sky forecast/time-machine requests under `/forecast/key/`. Returns (server, base url).
+    """
+    eonet_body = json.dumps(eonet_payload).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path.startswith('/events'):
+                body = eonet_body
+            else:
+                parts = path.rsplit('/', 1)[-1].split(',')
+                ts = int(parts[2]) if len(parts) > 2 else int(time.time())
+                days = [make_weather_record(ts + 86400 * d) for d in range(8 if len(parts) == 2 else 1)]
+                body = json.dumps({'daily': {'data': days}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def _mongomock_client():
+    """Returns a mongomock client, or exits when mongomock is missing or cannot run the bulk
+    upserts of the installed pymongo.
+    """
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock is not installed; pass --mongo-uri of a scratch MongoDB")
+    import pymongo
+    client = mongomock.MongoClient()
+    try:
+        client[BENCH_DB]['probe'].bulk_write([pymongo.ReplaceOne({'_id': 0}, {'_id': 0}, upsert=True)])
+    except (TypeError, NotImplementedError) as e:
+        sys.exit("mongomock {} does not support pymongo {} ({}); pass --mongo-uri of a scratch "
+                 "MongoDB".format(mongomock.__version__, pymongo.version, e))
+    return client
+
+
+def use_mongo(uri=None):
+    """Points `database` at a scratch database: mongomock when `uri` is None, else `uri`"""
+    import database
+    if uri is None:
+        database.client, database._client_pid = _mongomock_client(), os.getpid()
+    else:
+        database.MONGO_URI = uri
+        database.client = None
+    database.MONGO_DB = BENCH_DB
+    database.get_client().drop_database(BENCH_DB)
+    database.ensure_indexes()
+    return database
+
+
+def timed(name, func, repeat, rows=None, setup=None):
+    """Runs `func` `repeat` times (after `setup`, untimed) and returns its result record"""
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    result = {'name': name, 'rows': rows, 'seconds': seconds, 'best': min(seconds),
+              'median': statistics.median(seconds)}
+    if rows:
+        result['rows_per_sec'] = rows / result['median'] if result['median'] else None
+    print("{:<32} rows={:<9} best={:.4f}s median={:.4f}s".format(name, rows or '-', result['best'],
+                                                                 result['median']))
+    return result
+
+
+def run(scale, repeat, mongo_uri=None):
+    """Runs every scenario at `scale` geometries and returns the list of result records"""
+    database = use_mongo(mongo_uri)
+    import data_acquire
+    import prediction
+    import visualization
+    import figures
+    import snapshot
+    snapshot.SNAPSHOT_DIR = tempfile.mkdtemp(prefix='snapshot_bench_')
+
+    payload = make_eonet_payload(scale)
+    server, base = start_stub_server(payload)
+    locations = [(34, -118), (47, -122)]
+    results = []
+    try:
+        df = data_acquire.filter_dis(payload, 'open')
+        results.append(timed('filter_dis', lambda: data_acquire.filter_dis(payload, 'open'), repeat, len(df)))
+        results.append(timed('download_disaster (stub)', lambda: data_acquire.download_disaster(
+            url=base + '/events', limit=scale, days=365, timeout=60.0), repeat, len(payload['events'])))
+        results.append(timed('stream ingest (stub)', lambda: data_acquire.ingest_events(
+            data_acquire.stream_disaster(url=base + '/events', days=365), 'closed'),
+            repeat, len(payload['events'])))
+
+        drop = lambda name: lambda: database.get_db(ingest=True).get_collection(name).delete_many({})
+        results.append(timed('upsert_dis insert', lambda: database.upsert_dis(df), repeat, len(df),
+                             setup=drop('disasters')))
+        results.append(timed('upsert_dis update', lambda: database.upsert_dis(df), repeat, len(df)))
+
+        weather = data_acquire.normalize_weather(make_weather_history(locations, 30))
+        results.append(timed('normalize_weather', lambda: data_acquire.normalize_weather(
+            make_weather_history(locations, 30)), repeat, len(weather)))
+        results.append(timed('upsert_wea', lambda: database.upsert_wea(weather), repeat, len(weather)))
+        results.append(timed('fetch_weather_days (stub)', lambda: data_acquire.fetch_weather_days(
+            locations, url=base + '/forecast/key/', use_cache=False), repeat, 62))
+
+        results.append(timed('fetch_all_dis_as_df', database.fetch_all_dis_as_df, repeat, len(df)))
+        year_ago = datetime.now() - timedelta(days=365)
+        results.append(timed('fetch_dis (pushdown)', lambda: database.fetch_dis(
+            title='Wildfires', status=['open'], since=year_ago), repeat))
+        results.append(timed('publish_snapshot', snapshot.publish_snapshot, repeat, len(df)))
+        results.append(timed('snapshot_dis (mmap)', lambda: snapshot.snapshot_dis(
+            title='Wildfires', status=['open'], since=year_ago), repeat))
+
+        wildfires = database.fetch_dis(title='Wildfires')
+        n_fires = 0 if wildfires is None else len(wildfires)
+        results.append(timed('prediction.kde (refit)', lambda: prediction.kde(wildfires, 0.2, 'la'), repeat,
+                             n_fires, setup=prediction._kde_cache.clear))
+        results.append(timed('prediction.kde (cached fit)', lambda: prediction.kde(wildfires, 0.2, 'la'),
+                             repeat, n_fires))
+
+        points = database.fetch_dis(fields=['geo1', 'geo2', 'datetime', 'status'])
+        results.append(timed('map_plot', lambda: visualization.map_plot(points), repeat, len(points)))
+        results.append(timed('map_plot to_json', lambda: visualization.map_plot(points).to_json(), repeat,
+                             len(points)))
+
+        status = ['open', 'closed']
+        results.append(timed('disaster callback (render)', lambda: visualization.disaster_visualization(
+            status, 'Wildfires'), repeat))
+        results.append(timed('alarm callback (render)', lambda: visualization.alarm_visualization('LA', 1),
+                             repeat))
+        figures.precompute_figures()
+        figures.load_figures()
+        results.append(timed('disaster callback (precomputed)', lambda: figures.get_figure(
+            figures.disaster_key(status, 'Wildfires'), lambda: None), repeat))
+        results.append(timed('alarm callback (precomputed)', lambda: figures.get_figure(
+            figures.alarm_key('LA', 1), lambda: None), repeat))
+    finally:
+        server.shutdown()
+        database.get_client().drop_database(BENCH_DB)
+        shutil.rmtree(snapshot.SNAPSHOT_DIR, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=int, default=10000, help='number of synthetic geometries')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scenario')
+    parser.add_argument('--mongo-uri', default=None, help='scratch MongoDB instead of mongomock')
+    parser.add_argument('--out', default=None, help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    report = {'meta': {'scale': args.scale, 'repeat': args.repeat,
+                       'mongo': 'mongomock' if args.mongo_uri is None else 'mongod',
+                       'python': platform.python_version(), 'pandas': pd.__version__,
+                       'numpy': np.__version__, 'timestamp': datetime.utcnow().isoformat()},
+              'results': run(args.scale, args.repeat, args.mongo_uri)}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Query result cache shared by the fetch functions in `database.py`.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueryCache:
+    """LRU cache of query results keyed by the query parameters.
+
+    An entry younger than `max_age_seconds` is served as is. An entry older than that but younger
+    than `max_age_seconds + stale_seconds` is still served, while a background thread reloads it
+    (stale-while-revalidate). Older or missing entries are loaded in the calling thread. Concurrent
+    callers asking for the same key share one load (single flight), so an expired entry never
+    sends more than one query to MongoDB.
+    """
+
+    def __init__(self, max_len=64, max_age_seconds=20, stale_seconds=40, refresh_workers=2):
+        self.max_len = max_len
+        self.max_age_seconds = max_age_seconds
+        self.stale_seconds = stale_seconds
+        self._entries = OrderedDict()           # key -> (value, loaded_at)
+        self._inflight = {}                     # key -> threading.Event of the running load
+        self._lock = threading.Lock()
+        self._refresh_workers = refresh_workers
+        self._executor = None
+        self._executor_pid = None
+        self._stats = {'hit': 0, 'stale_hit': 0, 'miss': 0, 'eviction': 0,
+                       'refresh': 0, 'refresh_seconds': 0.0, 'last_refresh_seconds': 0.0}
+
+    def get(self, key, loader):
+        """Returns the cached result of `loader()` for `key`, loading or refreshing it as needed."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                age = None if entry is None else time.time() - entry[1]
+                if age is not None and age < self.max_age_seconds + self.stale_seconds:
+                    self._entries.move_to_end(key)
+                    if age < self.max_age_seconds:
+                        self._stats['hit'] += 1
+                    else:
+                        self._stats['stale_hit'] += 1
+                        if key not in self._inflight:
+                            self._inflight[key] = threading.Event()
+                            self._get_executor().submit(self._load, key, loader)
+                    return entry[0]
+                event = self._inflight.get(key)
+                if event is None:
+                    self._stats['miss'] += 1
+                    self._inflight[key] = threading.Event()
+                    break
+            event.wait()                        # another thread is loading `key`, then retry
+        return self._load(key, loader)
+
+    def _load(self, key, loader):
+        start = time.time()
+        try:
+            value = loader()
+            with self._lock:
+                self._entries[key] = (value, time.time())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_len:
+                    self._entries.popitem(last=False)
+                    self._stats['eviction'] += 1
+                elapsed = time.time() - start
+                self._stats['refresh'] += 1
+                self._stats['refresh_seconds'] += elapsed
+                self._stats['last_refresh_seconds'] = elapsed
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key).set()
+
+    def _get_executor(self):
+        if self._executor is None or self._executor_pid != os.getpid():    # threads do not survive a fork
+            self._executor = ThreadPoolExecutor(max_workers=self._refresh_workers)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def clear(self):
+        """Drops all cached entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit/miss counters, refresh timings, hit rate and size of the cache"""
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+        lookups = stats['hit'] + stats['stale_hit'] + stats['miss']
+        stats['hit_rate'] = (stats['hit'] + stats['stale_hit']) / lookups if lookups else 0.0
+        return stats
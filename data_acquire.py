@@ -2,105 +2,241 @@
 Earth Observatory Natural Event Tracker.
 """
 import time
-import sched
+_import_start = time.perf_counter()
+
 import pandas as pd
 from datetime import datetime, timedelta
+import re
 import json
+import codecs
+import hashlib
 import logging
+import threading
 import requests
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 
 import utils
-from database import upsert_dis, upsert_wea
+import metrics
+from scheduler import JobScheduler
+from http_client import get_json, get_session, breaker, CircuitOpen
+from database import upsert_dis, upsert_wea, ensure_indexes, ensure_rollups
+from database import get_sync_state, set_sync_state, mark_closed, fetch_wea_dates, oldest_dis_date
+from snapshot import publish_snapshot
 
 
 DIS_SOURCE = "https://eonet.sci.gsfc.nasa.gov/api/v2.1/events"
 W_SOURCE = "https://api.darksky.net/forecast/b4c50d35d2b602d506c708a505757c25/"
+DIS_TITLES = ["Wildfires", "Severe_Storms", "Sea_and_Lake_Ice"]
 MAX_DOWNLOAD_ATTEMPT = 3
 DOWNLOAD_PERIOD = 300        # second
+CLOSED_SYNC_PERIOD = 3600    # second between reconciliations of closed events
+WEATHER_LOCATIONS = [(34, -118), (47, -122)]    # (lat, lon) of LA and Seattle
+WEATHER_HISTORY_DAYS = 30    # past days downloaded per location
+WEATHER_MAX_WORKERS = 8      # concurrent weather requests
+# Columns of the weather collection, in the order the alarm models were trained on. Small integer
+# readings are float32; decimal readings stay float64 so they are stored in Mongo unchanged.
+WEATHER_SCHEMA = [('apparentTemperatureHigh', 'float64'), ('apparentTemperatureLow', 'float64'),
+                  ('apparentTemperatureMax', 'float64'), ('apparentTemperatureMin', 'float64'),
+                  ('cloudCover', 'float64'), ('date', 'datetime64[ns]'), ('dewPoint', 'float64'),
+                  ('humidity', 'float64'), ('lat', 'float64'), ('long', 'float64'),
+                  ('moonPhase', 'float64'), ('ozone', 'float64'), ('pressure', 'float64'),
+                  ('temperatureHigh', 'float64'), ('temperatureLow', 'float64'),
+                  ('temperatureMax', 'float64'), ('temperatureMin', 'float64'),
+                  ('uvIndex', 'float32'), ('visibility', 'float64'), ('windBearing', 'float32'),
+                  ('windGust', 'float64'), ('windSpeed', 'float64')]
+WEATHER_FINAL_AFTER_DAYS = 2 # past days older than this are final and served from the database
+STREAM_CHUNK_BYTES = 65536   # bytes read per network chunk when streaming
+STREAM_CHUNK_EVENTS = 200    # events converted and upserted together when streaming
+JOB_WORKERS = 4              # acquisition jobs running at the same time
+JOB_JITTER = 15              # second, random delay added to every job interval
+HISTORY_TIMEOUT = 600        # second
+METRICS_PERIOD = 900         # second between metrics summaries in the log
+SYNC_INITIAL_DAYS = 100      # window requested before any high-water mark exists
+SYNC_OVERLAP_DAYS = 2        # days re-requested behind the high-water mark
+IMPORT_BUDGET = 1.0          # second importing this module may take before a warning
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'data.log')
+weather_cache_stats = {'hit': 0, 'miss': 0}
+_sync_lock = threading.Lock()    # the open and closed syncs both rewrite the open sync state
 
+@metrics.timed('download_disaster')
 def download_disaster(url=DIS_SOURCE, retries=MAX_DOWNLOAD_ATTEMPT, limit = 10, days = 2, status = "open", timeout = 1.0):
     """Returns disaster information text from `DIS_SOURCE` that includes disaster information
-    Returns None if network failed
+    Returns None if network failed. Retries, backoff and conditional requests are handled by
+    `http_client.get_json`.
     """
-    js = None
-    for _ in range(retries):
-        try:
-            req = requests.get(f"{url}?limit={limit}&days={days}&status={status}", timeout=timeout)
-            req.raise_for_status()
-            text = req.text
-            js = json.loads(text)
-        except requests.exceptions.HTTPError as e:
-            logger.warning("Retry on HTTP Error: {}".format(e))
+    js = get_json(f"{url}?limit={limit}&days={days}&status={status}", retries, timeout, conditional=True)
     if js is None:
         logger.error('download_dis too many FAILED attempts')
     return js, status
 
 
+def _geometry_point(geometry):
+    """Returns the (lon, lat) of a Point geometry, or the vertex centroid of the outer ring of
+    a Polygon geometry.
+    """
+    coords = geometry['coordinates']
+    if geometry.get('type') == 'Polygon':
+        ring = np.asarray(coords[0], dtype=np.float64)
+        if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+            ring = ring[:-1]                    # GeoJSON rings repeat the first vertex at the end
+        return ring[:, 0].mean(), ring[:, 1].mean()
+    return float(coords[0]), float(coords[1])
+
+
+def _parse_dates(dates):
+    """Returns the EONET ISO 8601 `dates` as a UTC datetime64 Series. Each date is parsed on its
+    own format, so date-only and full timestamps can be mixed; malformed dates become NaT.
+    """
+    return pd.to_datetime(pd.Series(dates, dtype=object), format='ISO8601', errors='coerce', utc=True)
+
+
+@metrics.timed('filter_dis')
 def filter_dis(js, status):
-    """Converts `json` to `DataFrame`
+    """Converts `json` to `DataFrame` with one row per event geometry
+    Columns are accumulated separately and typed in one pass: float64 coordinates, datetime64
+    dates parsed in a single call and categorical title/status. Polygons become their centroid.
+    Geometries whose date cannot be parsed are dropped and counted, like malformed events.
     """
-    data = []
-    filter_tits = ["Wildfires", "Severe_Storms", "Sea_and_Lake_Ice"]
+    events, counts = [], []
+    dates, lons, lats = [], [], []
+    skipped = 0
     for x in js["events"]:
         tit = x["categories"][0]["title"].replace(" ","_")
-        if tit not in filter_tits:
+        if tit not in DIS_TITLES:
             continue
         try:
-            id = x["categories"][0]["id"]
-            subtit, subid, url = x['title'], x['id'], x['sources'][0]['url'] if x["sources"] else None
-            g = x["geometries"]
-            for gg in g:
-                dt, geo = pd.to_datetime(gg["date"]), gg['coordinates']
-                singled = [id, tit, subtit, subid, dt, geo[0], geo[1], status, url]
-                data.append(singled)
-        except:
+            event = (x["categories"][0]["id"], tit, x['title'], x['id'],
+                     x['sources'][0]['url'] if x["sources"] else None)
+            points = [(gg["date"],) + _geometry_point(gg) for gg in x["geometries"]]
+        except (KeyError, IndexError, TypeError, ValueError):
+            skipped += 1
             continue
-    data = np.array(data)
-    df = pd.DataFrame(data, columns = ["id", "title", "subid", "subtitle", "datetime", "geo1", "geo2", "status", "url"])
+        events.append(event)
+        counts.append(len(points))
+        for dt, lon, lat in points:
+            dates.append(dt)
+            lons.append(lon)
+            lats.append(lat)
+    if skipped:
+        logger.warning("skipped {} malformed events".format(skipped))
+
+    columns = list(zip(*events)) or [()] * 5
+    repeat = lambda values, dtype=object: np.repeat(np.array(values, dtype=dtype), counts)
+    df = pd.DataFrame({
+        "id": repeat(columns[0], np.int64),
+        "title": pd.Categorical(repeat(columns[1]), categories=DIS_TITLES),
+        "subid": repeat(columns[2]),
+        "subtitle": repeat(columns[3]),
+        "datetime": _parse_dates(dates),
+        "geo1": np.array(lons, dtype=np.float64),
+        "geo2": np.array(lats, dtype=np.float64),
+        "status": pd.Categorical([status] * len(dates), categories=["open", "closed"]),
+        "url": repeat(columns[4]),
+    })
+    invalid = df["datetime"].isna()
+    if invalid.any():
+        logger.warning("skipped {} geometries with malformed dates".format(invalid.sum()))
+        df = df[~invalid].reset_index(drop=True)
+    metrics.inc('filter_dis_rows', len(df))
     return df
 
 
+def _missing_days(loc, tstamps, use_cache):
+    """Returns the time-machine timestamps of `tstamps` that have to be requested for `loc`.
+    With `use_cache`, days older than `WEATHER_FINAL_AFTER_DAYS` whose observation is already stored
+    in the `weather` collection are skipped, since past observations no longer change. A day stored
+    only from the forecast feed is requested again until its observation arrives.
+    """
+    if not use_cache:
+        return list(tstamps)
+    final_before = datetime.now() - timedelta(days=WEATHER_FINAL_AFTER_DAYS)
+    day = lambda ts: datetime(*datetime.fromtimestamp(ts).timetuple()[:3])
+    stored = fetch_wea_dates(loc[0], loc[1], day(min(tstamps)))
+    missing = [ts for ts in tstamps if datetime.fromtimestamp(ts) > final_before or day(ts) not in stored]
+    weather_cache_stats['hit'] += len(tstamps) - len(missing)
+    weather_cache_stats['miss'] += len(missing)
+    metrics.inc('weather_cache_hit', len(tstamps) - len(missing))
+    metrics.inc('weather_cache_miss', len(missing))
+    return missing
+
+
+@metrics.timed('fetch_weather_days')
+def fetch_weather_days(locations, url=W_SOURCE, retries=MAX_DOWNLOAD_ATTEMPT, timeout=1.0,
+                       days=WEATHER_HISTORY_DAYS, max_workers=WEATHER_MAX_WORKERS, use_cache=True):
+    """Downloads the forecast and the last `days` daily observations of every (lat, lon) in
+    `locations`, running at most `max_workers` requests at a time on the pooled session.
+    Past days already final in the database are not requested again, see `_missing_days`.
+    Returns a dict mapping each location to its list of daily records, or to None when its
+    forecast request failed. Failed past-day requests are left out of the list; the past-day
+    records that arrived are tagged `observed`.
+    """
+    tstamp = int(datetime.now().timestamp())
+    tstamps = list(range(tstamp, tstamp-86400*days, -86400))
+    hit, miss = weather_cache_stats['hit'], weather_cache_stats['miss']
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        forecasts = {loc: pool.submit(get_json, f"{url}{loc[0]},{loc[1]}", retries, timeout)
+                     for loc in locations}
+        history = {loc: [pool.submit(get_json, f'{url}{loc[0]},{loc[1]},{ts}?exclude=hourly,currently',
+                                     retries, 3.0)
+                         for ts in _missing_days(loc, tstamps, use_cache)]
+                   for loc in locations}
+        logger.info("locations={}, hit={}, miss={}".format(len(locations), weather_cache_stats['hit']-hit,
+                                                           weather_cache_stats['miss']-miss))
+        result = {}
+        for loc in locations:
+            js = forecasts[loc].result()
+            past = [f.result() for f in history[loc]]
+            if js is None:
+                logger.error('download_wea too many FAILED attempts for {}'.format(loc))
+                result[loc] = None
+                continue
+            result[loc] = js['daily']['data'] + [dict(p['daily']['data'][0], observed=True)
+                                                 for p in past if p is not None]
+    return result
+
+
+@metrics.timed('normalize_weather')
+def normalize_weather(data, max_age_days=WEATHER_HISTORY_DAYS):
+    """Converts the daily records of many locations, given as the {(lat, lon): records} dict
+    returned by `fetch_weather_days`, into one weather `DataFrame` built in a single construction.
+    Only the `WEATHER_SCHEMA` columns are kept, with its dtypes, plus the boolean `observed` that
+    tells time-machine observations from forecasts. Days older than `max_age_days` are dropped, and
+    of records for the same location and day the later one in the list wins.
+    """
+    lats, lons, records = [], [], []
+    for (lat, lon), recs in data.items():
+        for r in recs or []:
+            lats.append(lat)
+            lons.append(lon)
+            records.append(r)
+    dates = [datetime(*datetime.fromtimestamp(r['time']).timetuple()[:3]) for r in records]
+    columns = {c: [r.get(c) for r in records] for c, _ in WEATHER_SCHEMA if c not in ('date', 'lat', 'long')}
+    columns.update(date=pd.to_datetime(pd.Series(dates, dtype=object)), lat=lats, long=lons)
+    df = pd.DataFrame({c: pd.Series(columns[c], dtype=dtype) for c, dtype in WEATHER_SCHEMA})
+    df['observed'] = np.array([bool(r.get('observed')) for r in records], dtype=bool)
+    df = df[df['date'] >= datetime.now() - timedelta(days=max_age_days)]
+    return df.drop_duplicates(subset=['long', 'lat', 'date'], keep='last').reset_index(drop=True)
+
+
 def download_weather(url=W_SOURCE, retries=MAX_DOWNLOAD_ATTEMPT, lat=34, lon=-118, timeout=1.0):
     """Returns weather forecast information dataframe from `W_SOURCE` that includes weather information
     Returns None if network failed
     """
-    df = None
-    for _ in range(retries):
-        try:
-            req = requests.get(f"{url}{lat},{lon}", timeout=timeout)
-            req.raise_for_status()
-            text = req.text
-            js = json.loads(text)
-            data1 = js['daily']['data']
-
-            tstamp = int(datetime.now().timestamp())
-            all_data = []
-            for ts in range(tstamp, tstamp-86400*30, -86400):
-                req = requests.get(f'{url}{lat},{lon},{ts}?exclude=hourly,currently', timeout=3.0)
-                req.raise_for_status()
-                text = req.text
-                js = json.loads(text)
-                data = js['daily']['data'][0]
-                all_data.append(data)
-            data = data1+all_data
-
-            df = pd.DataFrame()
-            for forecast in data:
-                dt = datetime.fromtimestamp(forecast['time'])
-                if dt < datetime.now()-timedelta(days=30):
-                    continue
-                fore_dict = {k:v for k,v in forecast.items() if ('Time' not in k and 'icon' not in k and 'summary' not in k and 'precip' not in k and 'time' not in k)}
-                fore_dict['long'], fore_dict['lat'],  fore_dict['date']= lon, lat, datetime(*dt.timetuple()[:3])
-                df = df.append(fore_dict, ignore_index=True)
-        except requests.exceptions.HTTPError as e:
-            logger.warning("Retry on HTTP Error: {}".format(e))
-    if js is None:
-        logger.error('download_wea too many FAILED attempts')
-    return df
+    data = fetch_weather_days([(lat, lon)], url, retries, timeout)
+    return None if data[(lat, lon)] is None else normalize_weather(data)
+
+
+def download_weather_many(locations=WEATHER_LOCATIONS, url=W_SOURCE, retries=MAX_DOWNLOAD_ATTEMPT, timeout=1.0):
+    """Returns one weather dataframe for all (lat, lon) in `locations`, fetched concurrently.
+    Locations whose download failed are skipped; returns None if all of them failed.
+    """
+    data = fetch_weather_days(locations, url, retries, timeout)
+    if all(recs is None for recs in data.values()):
+        return None
+    return normalize_weather(data)
 
 
 def update_once_d():
@@ -109,15 +245,157 @@ def update_once_d():
     upsert_dis(df)
 
 
-def update_once_w():
-    df1 = download_weather(lat=34, lon=-118)
-    upsert_wea(df1)
-    df2 = download_weather(lat=47, lon=-122)
-    upsert_wea(df2)
+def update_once_w(locations=WEATHER_LOCATIONS):
+    df = download_weather_many(locations)
+    if df is not None:
+        upsert_wea(df)
 
 
-def update_history():
+def event_hash(event):
+    """Returns a digest of the parts of an EONET `event` that end up in `filter_dis` rows.
+    The `closed` date is left out, so an event keeps its hash when it moves from open to closed.
+    """
+    content = {k: v for k, v in event.items() if k != 'closed'}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+@metrics.timed('update_incremental_d')
+def update_incremental_d(status="open"):
+    """Downloads only the EONET events of `status` past the stored high-water mark and upserts
+    the ones whose content hash changed. Closed events that were already stored as open are
+    flipped to closed in place rather than re-inserted.
+
+    An event closes long after its last geometry, so the closed window does not follow the
+    high-water mark: it spans at least `SYNC_INITIAL_DAYS` and reaches back to the oldest
+    geometry still stored as open. That makes the closed sync much larger than the open one,
+    so `main_loop` runs it on its own `CLOSED_SYNC_PERIOD`.
+    """
+    with _sync_lock:
+        _sync_status(status)
+
+
+def _sync_status(status):
+    state = get_sync_state(status) or {}
+    last_date, hashes = state.get('last_date'), state.get('hashes', {})
+    if status == "closed":
+        oldest = oldest_dis_date("open")
+        days = SYNC_INITIAL_DAYS
+        if oldest is not None:
+            days = max(days, (datetime.utcnow() - oldest).days + SYNC_OVERLAP_DAYS)
+    elif last_date is None:
+        days = SYNC_INITIAL_DAYS
+    else:
+        days = max(1, (datetime.utcnow() - last_date).days + SYNC_OVERLAP_DAYS)
+    js, s = download_disaster(limit=1000, days=days, status=status)
+    if js is None:
+        return
+
+    events = js["events"]
+    seen = {e['id']: event_hash(e) for e in js["events"]}
+    if status == "closed":
+        open_state = get_sync_state("open") or {}
+        open_hashes = open_state.get('hashes', {})
+        transitions = [i for i in seen if i in open_hashes and i not in hashes]
+        mark_closed(transitions)
+        if transitions and open_state:
+            set_sync_state("open", open_state.get('last_date'),
+                           {k: v for k, v in open_hashes.items() if k not in seen})
+        changed = [e for e in events if seen[e['id']] not in (hashes.get(e['id']), open_hashes.get(e['id']))]
+    else:
+        changed = [e for e in events if seen[e['id']] != hashes.get(e['id'])]
+
+    if changed:
+        upsert_dis(filter_dis({"events": changed}, s))
+    dates = _parse_dates([g.get("date") for e in events for g in e.get("geometries", [])]).dropna()
+    if len(dates):
+        newest = dates.max().tz_localize(None).to_pydatetime()
+        last_date = newest if last_date is None else max(last_date, newest)
+    hashes.update(seen)
+    set_sync_state(status, last_date, hashes)
+    logger.info("status={}, days={}, events={}, changed={}".format(status, days, len(events), len(changed)))
+
+
+def _iter_json_array(chunks, key="events"):
+    """Yields the elements of the array stored under `key` in a JSON document that arrives as
+    byte `chunks`, decoding one element at a time so only the current element is held in memory.
+    """
+    decoder, text = json.JSONDecoder(), codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf, pos, start = '', 0, None
+    while True:
+        if start is None:
+            match = re.search(r'"{}"\s*:\s*\['.format(key), buf)
+            if match:
+                buf, pos, start = buf[match.end():], 0, True
+                continue
+        else:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if buf[pos:pos+1] == ']':
+                return
+            if pos < len(buf):
+                try:
+                    element, pos = decoder.raw_decode(buf, pos)
+                    yield element
+                    continue
+                except json.JSONDecodeError:
+                    pass
+            buf, pos = buf[pos:], 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("JSON document ended inside `{}`".format(key))
+        buf += text.decode(chunk)
+
+
+def stream_disaster(url=DIS_SOURCE, limit=1000, days=1000, status="closed", timeout=60.0,
+                    chunk_size=STREAM_CHUNK_BYTES):
+    """Yields EONET events from `DIS_SOURCE` one at a time while the response is still being read,
+    so the full payload is never held in memory.
+    """
+    circuit = breaker(url)
+    if not circuit.allow():
+        raise CircuitOpen(url)
+    ok = False
+    try:
+        with get_session().get(f"{url}?limit={limit}&days={days}&status={status}",
+                               timeout=timeout, stream=True) as req:
+            req.raise_for_status()
+            ok = True       # the host answered; a consumer closing the stream early is not its failure
+            yield from _iter_json_array(req.iter_content(chunk_size))
+    except (requests.exceptions.RequestException, ValueError):
+        ok = False
+        raise
+    finally:
+        circuit.record(ok)
+
+
+@metrics.timed('ingest_events')
+def ingest_events(events, status, chunk_events=STREAM_CHUNK_EVENTS):
+    """Converts and upserts an iterable of EONET `events` in chunks of `chunk_events`, so peak
+    memory is bounded by one chunk. Returns the number of events consumed.
+    """
+    batch, total = [], 0
+    for event in events:
+        batch.append(event)
+        if len(batch) >= chunk_events:
+            upsert_dis(filter_dis({"events": batch}, status))
+            total, batch = total + len(batch), []
+    if batch:
+        upsert_dis(filter_dis({"events": batch}, status))
+        total += len(batch)
+    return total
+
+
+def update_history(stream=True):
+    """Backfills closed disasters of the last 1000 days. With `stream`, events are parsed from the
+    response as it arrives and flushed in bounded chunks (`ingest_events`).
+    """
     try:
+        if stream:
+            total = ingest_events(stream_disaster(limit=1000, days=1000, status="closed", timeout=60.0),
+                                  "closed")
+            print("History disaster data updated ({} events)..........".format(total))
+            return
         t, s = download_disaster(limit = 1000, days = 1000, status = "closed", timeout = 60.0)
         print("History disaster data requested..........")
         df = filter_dis(t, s)
@@ -128,23 +406,53 @@ def update_history():
         logger.warning("history disaster worker ignores exception and continues: {}".format(e))
 
 
+def update_once_grids():
+    from prediction import update_rate_grids     # sklearn is only needed by this job
+    update_rate_grids()
 
-def main_loop(timeout=DOWNLOAD_PERIOD):
-    scheduler = sched.scheduler(time.time, time.sleep)
 
-    def _worker():
-        try:
-            update_once_d()
-            update_once_w()
-        except Exception as e:
-            logger.warning("main loop worker ignores exception and continues: {}".format(e))
-        scheduler.enter(timeout, 1, _worker)    # schedule the next event
+def update_once_figures():
+    from figures import precompute_figures      # plotly and the models are only needed by this job
+    precompute_figures()
 
-    scheduler.enter(0, 1, _worker)              # start the first event
-    scheduler.run(blocking=True)
+
+def main_loop(timeout=DOWNLOAD_PERIOD, incremental=True, history=True, max_workers=JOB_WORKERS):
+    """Runs the acquisition jobs every `timeout` seconds on a `JobScheduler` worker pool: disasters
+    (open events synced past the stored high-water mark with `incremental`, closed events
+    reconciled every `CLOSED_SYNC_PERIOD` seconds), weather once per location in
+    `WEATHER_LOCATIONS` and, with `history`, a one-off history backfill that no longer delays the
+    first periodic updates. Each disaster update is followed by the columnar disaster snapshot,
+    then the wildfire-rate grids; the dashboard figures are re-rendered after the grids or the
+    weather changed. Returns only when interrupted.
+    """
+    scheduler = JobScheduler(max_workers=max_workers)
+    scheduler.add_job('disaster', (lambda: update_incremental_d("open")) if incremental else update_once_d,
+                      interval=timeout, timeout=timeout, jitter=JOB_JITTER)
+    if incremental:
+        scheduler.add_job('closed disaster', lambda: update_incremental_d("closed"),
+                          interval=CLOSED_SYNC_PERIOD, timeout=CLOSED_SYNC_PERIOD, jitter=JOB_JITTER)
+    for loc in WEATHER_LOCATIONS:
+        scheduler.add_job('weather {},{}'.format(*loc), lambda loc=loc: update_once_w([loc]),
+                          interval=timeout, timeout=timeout, jitter=JOB_JITTER)
+    scheduler.add_job('snapshot', publish_snapshot, timeout=timeout,
+                      after=['disaster', 'closed disaster', 'history'])
+    scheduler.add_job('rate grids', update_once_grids, timeout=timeout, after=['snapshot'])
+    scheduler.add_job('figures', update_once_figures, timeout=timeout,
+                      after=['rate grids'] + ['weather {},{}'.format(*loc) for loc in WEATHER_LOCATIONS])
+    scheduler.add_job('metrics summary', lambda: logger.info("metrics: {}".format(metrics.summary())),
+                      interval=METRICS_PERIOD, delay=METRICS_PERIOD)
+    if history:
+        scheduler.add_job('history', update_history, timeout=HISTORY_TIMEOUT)
+    try:
+        scheduler.run()
+    finally:
+        scheduler.stop()
+        logger.info("job status: {}".format(scheduler.status()))
 
 
+metrics.observe('import_data_acquire', utils.log_import_time(logger, __name__, _import_start, IMPORT_BUDGET))
 
 if __name__ == '__main__':
-    update_history()
+    ensure_indexes()
+    ensure_rollups()
     main_loop()
\ No newline at end of file
@@ -1,62 +1,482 @@
+import os
+import math
 import logging
+import threading
 import pymongo
+from pymongo import ReadPreference
+from pymongo.write_concern import WriteConcern
 import pandas as pd
 import expiringdict
 import utils
+import metrics
+from datetime import datetime, timedelta
+from cache import QueryCache
+from spatial import GridIndex, EARTH_RADIUS_KM
 
-client = pymongo.MongoClient()
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'db.log')
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
+MONGO_DB = os.environ.get('MONGO_DB', 'disaster')
+MONGO_OPTIONS = {'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 50)),
+                 'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+                 'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_MS', 5000)),
+                 'connectTimeoutMS': int(os.environ.get('MONGO_CONNECT_MS', 5000)),
+                 'socketTimeoutMS': int(os.environ.get('MONGO_SOCKET_MS', 30000))}
+# Dashboard reads may go to secondaries; the ingester always reads and writes on the primary
+READ_PREFERENCE = os.environ.get('MONGO_READ_PREFERENCE', 'primary_preferred')
+# `MONGO_INGEST_W` is a node count or a tag such as `majority`; `MONGO_INGEST_J` waits for the journal
+_ingest_w = os.environ.get('MONGO_INGEST_W', '1')
+INGEST_WRITE_CONCERN = WriteConcern(w=int(_ingest_w) if _ingest_w.isdigit() else _ingest_w,
+                                    j=os.environ.get('MONGO_INGEST_J', 'false').lower() in ('1', 'true', 'yes'))
 RESULT_CACHE_EXPIRATION = 20             # seconds
+QUERY_CACHE_SIZE = 64                    # distinct queries kept per collection
+QUERY_CACHE_STALE = 40                   # seconds an expired result is served while refreshing
+QUERY_SINCE_RESOLUTION = 60              # seconds; `since` is floored to this when cached
+UPSERT_BATCH_SIZE = 500                  # operations per bulk_write round trip
+ROLLUP_CELL = 1.0                        # degrees of the region cells of the daily rollup
+SPATIAL_INDEX_CACHE_SIZE = 8             # query results whose spatial index is kept
 
+client = None
+_client_pid = None
+_client_lock = threading.Lock()
 
-def upsert_dis(df):
+
+def get_client():
+    """Returns the process-wide `MongoClient` configured by `MONGO_URI` and `MONGO_OPTIONS`.
+    It is created lazily on first use, so importing this module opens no connection, and again
+    in a forked child (e.g. a WSGI worker), which must not reuse its parent's sockets.
+    """
+    global client, _client_pid
+    with _client_lock:
+        if client is None or _client_pid != os.getpid():
+            client = pymongo.MongoClient(MONGO_URI, connect=False, **MONGO_OPTIONS)
+            _client_pid = os.getpid()
+    return client
+
+
+def get_db(ingest=False):
+    """Returns database `MONGO_DB` (`disaster` by default). With `ingest`, reads go to the primary
+    and writes use `INGEST_WRITE_CONCERN`; otherwise reads follow `READ_PREFERENCE`.
+    """
+    if ingest:
+        return get_client().get_database(MONGO_DB, read_preference=ReadPreference.PRIMARY,
+                                         write_concern=INGEST_WRITE_CONCERN)
+    return get_client().get_database(MONGO_DB,
+                                     read_preference=getattr(ReadPreference, READ_PREFERENCE.upper()))
+
+
+# Natural keys identifying one document. A disaster row is one geometry of one EONET event; note
+# that `filter_dis` stores the EONET event id under `subtitle` and the event title under `subid`.
+DIS_KEY = ['subtitle', 'datetime', 'geo1', 'geo2']
+WEA_KEY = ['long', 'lat', 'date']
+# Secondary indexes serving the filters of `fetch_dis` and `fetch_wea`
+QUERY_INDEXES = [("disasters", ['title', 'status', 'datetime']),
+                 ("weather", ['lat', 'date'])]
+
+
+def ensure_indexes():
+    """Creates the unique natural-key indexes the upserts filter on, the `QUERY_INDEXES` used
+    by the fetch functions and the 2dsphere index on the disaster `loc`. Safe to call repeatedly;
+    an index that cannot be built (e.g. legacy duplicates in the collection) is logged and skipped.
+    """
+    db = get_db(ingest=True)
+    for name, key in [("disasters", DIS_KEY), ("weather", WEA_KEY)]:
+        try:
+            db.get_collection(name).create_index([(k, pymongo.ASCENDING) for k in key],
+                                                 unique=True, name="natural_key")
+        except pymongo.errors.OperationFailure as e:
+            logger.warning("cannot create natural key index on {}: {}".format(name, e))
+    for name, key in QUERY_INDEXES:
+        db.get_collection(name).create_index([(k, pymongo.ASCENDING) for k in key])
+    db.get_collection("disasters").create_index([('loc', pymongo.GEOSPHERE)])
+
+
+def _bulk_upsert(collection, operations, batch_size=UPSERT_BATCH_SIZE, ordered=False):
+    """Sends `operations` to `collection` through `bulk_write` in batches of at most `batch_size`.
+    With `ordered` False the server may apply a batch in any order and keeps going past a failed
+    operation. Returns the matched and modified counts summed over all batches and the positions
+    in `operations` of the upserts that inserted a new document.
+    """
+    matched = modified = 0
+    inserted = []
+    for start in range(0, len(operations), batch_size):
+        result = collection.bulk_write(operations[start:start+batch_size], ordered=ordered)
+        matched += result.matched_count
+        modified += result.modified_count
+        inserted.extend(start + i for i in result.upserted_ids)
+    return matched, modified, inserted
+
+
+@metrics.timed('upsert_dis')
+def upsert_dis(df, batch_size=UPSERT_BATCH_SIZE, ordered=False):
     """
     Update MongoDB database `disaster` and collection `disasters` with the given `DataFrame`.
+    Rows are written in `bulk_write` batches of `batch_size`, see `_bulk_upsert`. Each document
+    also stores its coordinates as a GeoJSON point `loc` for the 2dsphere index.
     """
-    db = client.get_database("disaster")
+    db = get_db(ingest=True)
     collection = db.get_collection("disasters")
-    update_count = 0
-    for record in df.to_dict('records'):
-        result = collection.replace_one(
-            filter=record,                              # locate the document if exists
-            replacement=record,                         # latest document
-            upsert=True)                                # update if exists, insert if not
-        if result.matched_count > 0:
-            update_count += 1
-    logger.info("rows={}, update={}, ".format(df.shape[0], update_count) +
-                "insert={}".format(df.shape[0]-update_count))
-
-def upsert_wea(df):
+    records = df.to_dict('records')
+    operations = [pymongo.ReplaceOne(
+                    filter={k:record[k] for k in DIS_KEY},  # locate the document if exists
+                    replacement=dict(record, loc={'type': 'Point',
+                                                  'coordinates': [record['geo1'], record['geo2']]}),
+                    upsert=True)                        # update if exists, insert if not
+                  for record in records]
+    matched, modified, inserted = _bulk_upsert(collection, operations, batch_size, ordered)
+    update_dis_rollup([records[i] for i in inserted])
+    metrics.inc('upsert_dis_rows', df.shape[0])
+    logger.info("rows={}, update={}, modified={}, ".format(df.shape[0], matched, modified) +
+                "insert={}".format(len(inserted)))
+
+
+@metrics.timed('upsert_wea')
+def upsert_wea(df, batch_size=UPSERT_BATCH_SIZE, ordered=False):
     """
     Update MongoDB database `disaster` and collection `weather` with the given `DataFrame`.
+    Rows are written in `bulk_write` batches of `batch_size`, see `_bulk_upsert`.
+    """
+    db = get_db(ingest=True)
+    collection = db.get_collection("weather")
+    operations = [pymongo.ReplaceOne(
+                    filter={k:record[k] for k in WEA_KEY},  # locate the document if exists
+                    replacement=record,                 # latest document
+                    upsert=True)                        # update if exists, insert if not
+                  for record in df.to_dict('records')]
+    matched, modified, inserted = _bulk_upsert(collection, operations, batch_size, ordered)
+    metrics.inc('upsert_wea_rows', df.shape[0])
+    logger.info("rows={}, update={}, modified={}, ".format(df.shape[0], matched, modified) +
+                "insert={}".format(len(inserted)))
+
+
+def _rollup_id(record):
+    """Returns the `dis_daily` key of a disaster record: UTC day, title and `ROLLUP_CELL` cell"""
+    ts = pd.Timestamp(record['datetime'])
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert(None)
+    return {'day': ts.normalize().to_pydatetime(), 'title': record['title'],
+            'lat_cell': math.floor(record['geo2'] / ROLLUP_CELL) * ROLLUP_CELL,
+            'lon_cell': math.floor(record['geo1'] / ROLLUP_CELL) * ROLLUP_CELL}
+
+
+def update_dis_rollup(records):
+    """Adds newly inserted disaster `records` to the `dis_daily` rollup, which counts geometries
+    per day, category and region cell and sums their coordinates. Only inserts are passed in,
+    so re-upserting a known geometry never counts it twice.
+    """
+    groups = {}
+    for record in records:
+        key = _rollup_id(record)
+        count, geo1, geo2 = groups.get(tuple(key.values()), (0, 0.0, 0.0))
+        groups[tuple(key.values())] = (count + 1, geo1 + record['geo1'], geo2 + record['geo2'])
+    if not groups:
+        return
+    db = get_db(ingest=True)
+    operations = [pymongo.UpdateOne({'_id': dict(zip(['day', 'title', 'lat_cell', 'lon_cell'], key))},
+                                    {'$inc': {'count': count, 'geo1_sum': geo1, 'geo2_sum': geo2}},
+                                    upsert=True)
+                  for key, (count, geo1, geo2) in groups.items()]
+    db.get_collection("dis_daily").bulk_write(operations, ordered=False)
+
+
+def rebuild_dis_rollup():
+    """Recomputes `dis_daily` from the whole `disasters` collection with one aggregation, e.g. to
+    initialise it for a history stored before the rollup existed.
+    """
+    db = get_db(ingest=True)
+    cell = lambda field: {'$multiply': [{'$floor': {'$divide': [field, ROLLUP_CELL]}}, ROLLUP_CELL]}
+    db.get_collection("disasters").aggregate([
+        {'$group': {'_id': {'day': {'$dateFromParts': {'year': {'$year': '$datetime'},
+                                                       'month': {'$month': '$datetime'},
+                                                       'day': {'$dayOfMonth': '$datetime'}}},
+                            'title': '$title', 'lat_cell': cell('$geo2'), 'lon_cell': cell('$geo1')},
+                    'count': {'$sum': 1}, 'geo1_sum': {'$sum': '$geo1'}, 'geo2_sum': {'$sum': '$geo2'}}},
+        {'$out': 'dis_daily'}])
+
+
+def ensure_rollups():
+    """Builds the rollups once when they are missing but disasters are stored"""
+    db = get_db(ingest=True)
+    if db.get_collection("dis_daily").find_one() is None and \
+            db.get_collection("disasters").find_one() is not None:
+        rebuild_dis_rollup()
+
+
+def fetch_dis_daily(title=None, since=None):
+    """Returns the `dis_daily` rollup rows as a `DataFrame` with columns `day`, `title`,
+    `lat_cell`, `lon_cell`, `count` and the cell centroid `geo1`/`geo2`, or None if empty.
+    """
+    query = {}
+    if title is not None:
+        query['_id.title'] = title
+    if since is not None:
+        query['_id.day'] = {'$gte': since}
+    db = get_db()
+    data = [dict(doc['_id'], count=doc['count'], geo1=doc['geo1_sum'] / doc['count'],
+                 geo2=doc['geo2_sum'] / doc['count'])
+            for doc in db.get_collection("dis_daily").find(query)]
+    if len(data) == 0:
+        return None
+    return pd.DataFrame.from_records(data)
+
+
+def get_sync_state(status):
+    """Returns the incremental sync state stored for EONET `status`, or None before the first sync.
+    The state holds the high-water mark `last_date` and a `hashes` map of event id to content hash.
+    """
+    db = get_db(ingest=True)
+    return db.get_collection("sync_state").find_one({'_id': status})
+
+
+def set_sync_state(status, last_date, hashes):
+    """Stores the incremental sync state for EONET `status`, see `get_sync_state`."""
+    db = get_db(ingest=True)
+    db.get_collection("sync_state").replace_one(
+        filter={'_id': status},
+        replacement={'_id': status, 'last_date': last_date, 'hashes': hashes},
+        upsert=True)
+
+
+def mark_closed(event_ids):
+    """Flips the stored geometries of the given EONET events from open to closed in place.
+    Returns the number of documents changed.
+    """
+    if not event_ids:
+        return 0
+    db = get_db(ingest=True)
+    collection = db.get_collection("disasters")
+    result = collection.update_many({'subtitle': {'$in': list(event_ids)}, 'status': 'open'},
+                                    {'$set': {'status': 'closed'}})
+    logger.info("closed={}, update={}".format(len(event_ids), result.modified_count))
+    return result.modified_count
+
+
+def oldest_dis_date(status):
+    """Returns the earliest `datetime` stored for disasters of `status`, or None if there are none"""
+    db = get_db(ingest=True)
+    doc = db.get_collection("disasters").find_one({'status': status}, {'datetime': 1, '_id': 0},
+                                                  sort=[('datetime', pymongo.ASCENDING)])
+    return None if doc is None else doc['datetime']
+
+
+def fetch_wea_dates(lat, lon, since):
+    """Returns the set of `date` values observed in `weather` for (lat, lon) from `since` on. Days
+    stored only from the forecast feed are left out.
     """
-    db = client.get_database("disaster")
+    db = get_db(ingest=True)
     collection = db.get_collection("weather")
-    update_count = 0
-    for record in df.to_dict('records'):
-        result = collection.replace_one(
-            filter={k:v for k,v in record.items() if k in ['long','lat','date']},       # locate the document if exists
-            replacement=record,                         # latest document
-            upsert=True)                                # update if exists, insert if not
-        if result.matched_count > 0:
-            update_count += 1
-    logger.info("rows={}, update={}, ".format(df.shape[0], update_count) +
-                "insert={}".format(df.shape[0]-update_count))
+    cursor = collection.find({'lat': lat, 'long': lon, 'date': {'$gte': since}, 'observed': True},
+                             {'date': 1, '_id': 0})
+    return {doc['date'] for doc in cursor}
+
+
+def _find_as_df(name, query, fields=None):
+    """Runs `query` on collection `name` with the projection `fields` (all fields when None) and
+    returns the result as a `DataFrame` without `_id`, or None if nothing matched.
+    """
+    db = get_db()
+    projection = {'_id': 0}
+    if fields is not None:
+        projection.update({f: 1 for f in fields})
+    data = list(db.get_collection(name).find(query, projection))
+    if len(data) == 0:
+        return None
+    return pd.DataFrame.from_records(data)
+
+
+def _floor_since(since):
+    """Floors `since` to `QUERY_SINCE_RESOLUTION` so that callers passing `now - delta` share a
+    cache key (and an identical query) for the duration of one resolution step.
+    """
+    if since is None:
+        return None
+    step = QUERY_SINCE_RESOLUTION
+    return datetime.fromtimestamp(int(since.timestamp()) // step * step)
+
+
+@metrics.timed('fetch_dis')
+def fetch_dis(title=None, status=None, since=None, bbox=None, fields=None, allow_cached=False):
+    """Returns the disasters matching all given filters as a `DataFrame`, filtered inside MongoDB.
+    `status` is one status or a list of them, `since` a datetime lower bound on `datetime` and
+    `bbox` a (min_lon, min_lat, max_lon, max_lat) box over `geo1`/`geo2`. When `allow_cached`,
+    the result is served from `dis_query_cache` keyed by the filters, with `since` floored by
+    `_floor_since`.
+    """
+    def _work():
+        query = {}
+        if title is not None:
+            query['title'] = title
+        if status is not None:
+            query['status'] = status if isinstance(status, str) else {'$in': list(status)}
+        if since is not None:
+            query['datetime'] = {'$gt': since}
+        if bbox is not None:
+            query['geo1'] = {'$gte': bbox[0], '$lte': bbox[2]}
+            query['geo2'] = {'$gte': bbox[1], '$lte': bbox[3]}
+        return _find_as_df("disasters", query, fields)
+
+    if not allow_cached:
+        return _work()
+    since = _floor_since(since)
+    key = (title, status if status is None or isinstance(status, str) else tuple(sorted(status)),
+           since, None if bbox is None else tuple(bbox), None if fields is None else tuple(fields))
+    return dis_query_cache.get(key, _work)
+
+
+@metrics.timed('fetch_wea')
+def fetch_wea(lat=None, lon=None, since=None, fields=None, allow_cached=False):
+    """Returns the weather rows of location (`lat`, `lon`) after `since` as a `DataFrame`, filtered
+    inside MongoDB. Any filter left as None is not applied. When `allow_cached`, the result is
+    served from `wea_query_cache`, see `fetch_dis`.
+    """
+    def _work():
+        query = {}
+        if lat is not None:
+            query['lat'] = lat
+        if lon is not None:
+            query['long'] = lon
+        if since is not None:
+            query['date'] = {'$gt': since}
+        return _find_as_df("weather", query, fields)
+
+    if not allow_cached:
+        return _work()
+    since = _floor_since(since)
+    key = (lat, lon, since, None if fields is None else tuple(fields))
+    return wea_query_cache.get(key, _work)
+
+
+@metrics.timed('fetch_wea_many')
+def fetch_wea_many(locations, since=None, until=None, fields=None, allow_cached=False):
+    """Returns the weather rows of every (lat, lon) in `locations` with `since` < `date` <= `until`
+    as one `DataFrame`, fetched with a single query. Caching is as in `fetch_wea`.
+    """
+    locations = sorted({(lat, lon) for lat, lon in locations})
+
+    def _work():
+        query = {'$or': [{'lat': lat, 'long': lon} for lat, lon in locations]}
+        if since is not None or until is not None:
+            query['date'] = {}
+            if since is not None:
+                query['date']['$gt'] = since
+            if until is not None:
+                query['date']['$lte'] = until
+        return _find_as_df("weather", query, fields)
+
+    if not locations:
+        return None
+    if not allow_cached:
+        return _work()
+    since = _floor_since(since)
+    key = (tuple(locations), since, until, None if fields is None else tuple(fields))
+    return wea_query_cache.get(key, _work)
+
+
+def fetch_dis_near(lat, lon, radius_km, since=None, title=None, fields=None):
+    """Returns the disasters within `radius_km` of (`lat`, `lon`) as a `DataFrame`, answered by
+    the 2dsphere index on `loc`. `since` and `title` filter as in `fetch_dis`.
+    """
+    query = {'loc': {'$geoWithin': {'$centerSphere': [[lon, lat], radius_km / EARTH_RADIUS_KM]}}}
+    if title is not None:
+        query['title'] = title
+    if since is not None:
+        query['datetime'] = {'$gt': since}
+    return _find_as_df("disasters", query, fields)
+
+
+def dis_spatial_index(df):
+    """Returns the `GridIndex` over the `geo2`/`geo1` coordinates of `df`. The index of the last
+    DataFrames seen is kept, so cached query results are only indexed once. Concurrent callbacks
+    share the cache under `_spatial_index_lock`; the index itself is built outside of it.
+    """
+    with _spatial_index_lock:
+        entry = _spatial_index_cache.get(id(df))
+    if entry is not None and entry[0] is df:
+        return entry[1]
+    entry = (df, GridIndex(df['geo2'].to_numpy(), df['geo1'].to_numpy()))
+    with _spatial_index_lock:
+        _spatial_index_cache.pop(id(df), None)
+        while len(_spatial_index_cache) >= SPATIAL_INDEX_CACHE_SIZE:
+            _spatial_index_cache.pop(next(iter(_spatial_index_cache)))
+        _spatial_index_cache[id(df)] = entry
+    return entry[1]
+
+
+def dis_within_radius(lat, lon, radius_km, days=None, title=None):
+    """Returns the cached disasters of the last `days` days within `radius_km` of (`lat`, `lon`),
+    answered by the in-process spatial index. Returns None when nothing matched.
+    """
+    since = None if days is None else datetime.now() - timedelta(days=days)
+    df = fetch_dis(title=title, since=since, allow_cached=True)
+    if df is None:
+        return None
+    found = df.iloc[dis_spatial_index(df).within_radius(lat, lon, radius_km)]
+    return found if len(found) else None
+
+
+def dis_within_bbox(bbox, days=None, title=None, status=None):
+    """Returns the cached disasters of the last `days` days inside the viewport
+    `bbox` = (min_lon, min_lat, max_lon, max_lat), answered by the in-process spatial index.
+    Returns None when nothing matched.
+    """
+    since = None if days is None else datetime.now() - timedelta(days=days)
+    df = fetch_dis(title=title, status=status, since=since, allow_cached=True)
+    if df is None:
+        return None
+    found = df.iloc[dis_spatial_index(df).within_bbox(*bbox)]
+    return found if len(found) else None
+
+
+def store_figures(figures):
+    """Stores precomputed figures, a dict of key to plotly JSON string, in collection `figures`"""
+    db = get_db(ingest=True)
+    now = datetime.utcnow()
+    operations = [pymongo.ReplaceOne({'_id': key}, {'_id': key, 'figure': fig, 'updated': now}, upsert=True)
+                  for key, fig in figures.items()]
+    if operations:
+        db.get_collection("figures").bulk_write(operations, ordered=False)
+
+
+def fetch_figures(since=None):
+    """Returns the stored figures updated after `since` as a list of dicts with `_id`, `figure`
+    and `updated`.
+    """
+    db = get_db()
+    query = {} if since is None else {'updated': {'$gt': since}}
+    return list(db.get_collection("figures").find(query))
+
+
+def query_cache_stats():
+    """Returns the statistics of both query caches, for monitoring"""
+    return {'disasters': dis_query_cache.stats(), 'weather': wea_query_cache.stats()}
 
 
 def fetch_all_dis():
-    db = client.get_database("disaster")
+    db = get_db()
     collection = db.get_collection("disasters")
     return list(collection.find())
 
 
 def fetch_all_wea():
-    db = client.get_database("disaster")
+    db = get_db()
     collection = db.get_collection("weather")
     return list(collection.find())
 
 
+dis_query_cache = QueryCache(max_len=QUERY_CACHE_SIZE, max_age_seconds=RESULT_CACHE_EXPIRATION,
+                             stale_seconds=QUERY_CACHE_STALE)
+
+wea_query_cache = QueryCache(max_len=QUERY_CACHE_SIZE, max_age_seconds=RESULT_CACHE_EXPIRATION,
+                             stale_seconds=QUERY_CACHE_STALE)
+
+for _name, _cache in [('dis', dis_query_cache), ('wea', wea_query_cache)]:
+    metrics.gauge('{}_query_cache_hit_ratio'.format(_name), lambda c=_cache: c.stats()['hit_rate'])
+    metrics.gauge('{}_query_cache_last_refresh_seconds'.format(_name),
+                  lambda c=_cache: c.stats()['last_refresh_seconds'])
+
+_spatial_index_cache = {}                # id(df) -> (df, GridIndex)
+_spatial_index_lock = threading.Lock()
+
 _fetch_all_dis_as_df_cache = expiringdict.ExpiringDict(max_len=1,
                                                        max_age_seconds=RESULT_CACHE_EXPIRATION)
 
@@ -64,6 +484,7 @@ _fetch_all_wea_as_df_cache = expiringdict.ExpiringDict(max_len=1,
                                                        max_age_seconds=RESULT_CACHE_EXPIRATION)
 
 
+@metrics.timed('fetch_all_dis_as_df')
 def fetch_all_dis_as_df(allow_cached=False):
     """Converts list of dicts returned by `fetch_all_dis` to DataFrame with ID removed
     Actual job is done in `_worker`. When `allow_cached`, attempt to retrieve timed cached from
@@ -88,6 +509,7 @@ def fetch_all_dis_as_df(allow_cached=False):
     return ret
 
 
+@metrics.timed('fetch_all_wea_as_df')
 def fetch_all_wea_as_df(allow_cached=False):
     """Converts list of dicts returned by `fetch_all_wea` to DataFrame with ID removed
     Actual job is done in `_worker`. When `allow_cached`, attempt to retrieve timed cached from
@@ -0,0 +1,93 @@
+"""
+Precomputed dashboard figures. The ingester renders every figure of the finite input space after
+each data update and stores them in MongoDB; each dashboard worker keeps them in memory and
+answers callbacks with a dictionary lookup.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+import utils
+import metrics
+from database import store_figures, fetch_figures
+from visualization import disaster_visualization, alarm_visualization
+
+DIS_KINDS = ['Wildfires', 'Severe_Storms', 'Sea_and_Lake_Ice']
+STATUS_SUBSETS = [[], ['open'], ['closed'], ['open', 'closed']]
+CITIES = ['LA', 'ST']
+RATES = [1, 2, 3]
+REFRESH_PERIOD = 30                 # second between polls for newly stored figures
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'app.log')
+
+_figures = {}                       # key -> plotly figure dict
+_loaded_until = None                # `updated` of the newest figure loaded
+_refresher_pid = None
+_lock = threading.Lock()
+
+
+def disaster_key(status, disaster):
+    return 'disaster|{}|{}'.format(disaster, ','.join(sorted(status or [])))
+
+
+def alarm_key(city, rate):
+    return 'alarm|{}|{}'.format(city, int(rate))
+
+
+def precompute_figures():
+    """Renders the world map of every disaster kind and status subset and the figure of every city
+    and alarm rate from uncached queries, and stores them for the dashboard workers. Run by the
+    ingester after data updates.
+    """
+    start = time.time()
+    figures = {}
+    for disaster in DIS_KINDS:
+        for status in STATUS_SUBSETS:
+            figure = disaster_visualization(status, disaster, allow_cached=False)
+            figures[disaster_key(status, disaster)] = figure.to_json()
+    for city in CITIES:
+        for rate in RATES:
+            figures[alarm_key(city, rate)] = alarm_visualization(city, rate, allow_cached=False).to_json()
+    store_figures(figures)
+    logger.info("figures={}, seconds={:.2f}".format(len(figures), time.time() - start))
+
+
+def load_figures():
+    """Pulls the figures stored since the last load into this process' memory"""
+    global _loaded_until
+    docs = fetch_figures(_loaded_until)
+    with _lock:
+        for doc in docs:
+            _figures[doc['_id']] = json.loads(doc['figure'])
+            if _loaded_until is None or doc['updated'] > _loaded_until:
+                _loaded_until = doc['updated']
+    return len(docs)
+
+
+def _refresh_loop():
+    while True:
+        try:
+            load_figures()
+        except Exception as e:
+            logger.warning("figure refresher ignores exception and continues: {}".format(e))
+        time.sleep(REFRESH_PERIOD)
+
+
+def _ensure_refresher():
+    """Starts the background refresher once per process; a forked WSGI worker starts its own"""
+    global _refresher_pid
+    with _lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+    threading.Thread(target=_refresh_loop, daemon=True, name='figure-refresher').start()
+
+
+def get_figure(key, render):
+    """Returns the precomputed figure `key`, or renders it with `render()` while none is stored"""
+    _ensure_refresher()
+    figure = _figures.get(key)
+    metrics.inc('figure_miss' if figure is None else 'figure_hit')
+    return render() if figure is None else figure
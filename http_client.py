@@ -0,0 +1,174 @@
+"""
+Shared HTTP client for the upstream APIs: pooled session, retries with backoff, conditional
+requests and a per-host circuit breaker.
+"""
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+
+import utils
+
+MAX_ATTEMPTS = 3
+BACKOFF = 0.5                # second, base of the exponential backoff
+MAX_BACKOFF = 30             # second, also caps Retry-After
+POOL_SIZE = 8                # keep-alive connections per host
+BREAKER_THRESHOLD = 5        # consecutive failures opening the circuit of a host
+BREAKER_RESET = 60           # second a circuit stays open before a trial request
+CONDITIONAL_CACHE_SIZE = 16  # responses kept for conditional requests
+RETRY_STATUS = {429, 500, 502, 503, 504}
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+_session = None
+_lock = threading.Lock()
+_conditional = OrderedDict()     # url -> (ETag, Last-Modified, decoded JSON)
+_breakers = {}                   # host -> CircuitBreaker
+
+
+class CircuitOpen(Exception):
+    """Raised instead of sending a request to a host whose circuit is open"""
+
+
+class CircuitBreaker:
+    """Counts consecutive failures of one host. After `threshold` of them the circuit opens and
+    requests fail fast for `reset_seconds`; then one trial request is let through (half open),
+    whose outcome closes or re-opens the circuit. A trial whose outcome is never recorded expires
+    after another `reset_seconds`, so a lost trial cannot keep the circuit open for good.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_seconds=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.time()
+            if now - (self._trial_at if self._trial else self.opened_at) >= self.reset_seconds:
+                self._trial, self._trial_at = True, now
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            self._trial = False
+            if ok:
+                self.failures, self.opened_at = 0, None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.error("circuit opened after {} failures".format(self.failures))
+                self.opened_at = time.time()
+
+
+def get_session():
+    """Returns the process-wide `requests.Session` whose keep-alive pool is shared by all
+    upstream requests, so repeated calls to the same host reuse TLS connections.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
+
+def breaker(url):
+    """Returns the `CircuitBreaker` of the host of `url`"""
+    host = urlsplit(url).netloc
+    with _lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker()
+        return _breakers[host]
+
+
+def _retry_after(req):
+    """Returns the delay in seconds asked for by a Retry-After header, or None"""
+    value = req.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_json(url, retries=MAX_ATTEMPTS, timeout=1.0, backoff=BACKOFF, conditional=False):
+    """GETs `url` and returns the decoded JSON, or None when every attempt failed, the request was
+    rejected with a non-retryable status or the host's circuit is open.
+
+    Returns as soon as one attempt succeeds. Request errors, undecodable bodies and `RETRY_STATUS`
+    responses are retried after `backoff * 2**attempt` seconds with full jitter, or after the
+    Retry-After delay when the server sends one. With `conditional`, the ETag/Last-Modified of the
+    previous response are sent and a 304 answer returns the previous JSON.
+    """
+    circuit = breaker(url)
+    for attempt in range(retries):
+        if not circuit.allow():
+            logger.warning("circuit open, skipping {}".format(url))
+            return None
+        headers, cached = {}, None
+        if conditional:
+            with _lock:
+                cached = _conditional.get(url)
+            if cached is not None:
+                if cached[0]:
+                    headers['If-None-Match'] = cached[0]
+                if cached[1]:
+                    headers['If-Modified-Since'] = cached[1]
+        delay, ok = None, False     # `ok` is recorded in `finally`, so no error leaves a trial open
+        try:
+            req = get_session().get(url, timeout=timeout, headers=headers)
+            if req.status_code == 304 and cached is not None:
+                ok = True
+                return cached[2]
+            if req.status_code in RETRY_STATUS:
+                delay = _retry_after(req)
+                raise requests.exceptions.HTTPError("{} Server Error for url: {}".format(req.status_code, url))
+            req.raise_for_status()
+            js = req.json()
+            ok = True
+        except (requests.exceptions.RequestException, ValueError) as e:
+            retryable = not isinstance(e, requests.exceptions.HTTPError) or \
+                e.response is None or e.response.status_code in RETRY_STATUS
+            ok = not retryable                  # a rejected request still means the host is up
+            if not retryable:
+                logger.error("Giving up on HTTP Error: {}".format(e))
+                return None
+            logger.warning("Retry on Error: {}".format(e))
+        finally:
+            circuit.record(ok)
+        if not ok:
+            if attempt + 1 < retries:
+                if delay is None:
+                    delay = random.uniform(0, backoff * 2 ** attempt)
+                time.sleep(min(delay, MAX_BACKOFF))
+            continue
+        if conditional and (req.headers.get('ETag') or req.headers.get('Last-Modified')):
+            with _lock:
+                _conditional[url] = (req.headers.get('ETag'), req.headers.get('Last-Modified'), js)
+                _conditional.move_to_end(url)
+                while len(_conditional) > CONDITIONAL_CACHE_SIZE:
+                    _conditional.popitem(last=False)
+        return js
+    return None
@@ -0,0 +1,113 @@
+"""
+Lightweight in-process metrics: counters and latency histograms with a Prometheus text export.
+"""
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')]
+
+_counters = {}                   # name -> float
+_histograms = {}                 # name -> [bucket counts, sum, count]
+_gauges = {}                     # name -> callable returning a number
+_lock = threading.Lock()
+
+
+def inc(name, value=1):
+    """Adds `value` to counter `name`"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """Records one duration in histogram `name`"""
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = [[0] * len(BUCKETS), 0.0, 0]
+        hist[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        hist[1] += seconds
+        hist[2] += 1
+
+
+def gauge(name, func):
+    """Registers `func` to be called for the current value of gauge `name` at export time"""
+    with _lock:
+        _gauges[name] = func
+
+
+@contextmanager
+def timer(name):
+    """Times the block into histogram `name`; failures are also counted in `<name>_errors`"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc(name + '_errors')
+        raise
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator timing every call of the function into histogram `name`, see `timer`"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def quantile(name, q):
+    """Returns the upper bound of the bucket holding quantile `q` of histogram `name`, or None"""
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None or hist[2] == 0:
+            return None
+        rank, seen = q * hist[2], 0
+        for bound, count in zip(BUCKETS, hist[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+    return None
+
+
+def summary():
+    """Returns {histogram: count, p50, p99, mean} and all counters and gauges, for log lines"""
+    with _lock:
+        names = list(_histograms)
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+    result = {name: {'count': _histograms[name][2], 'p50': quantile(name, 0.5), 'p99': quantile(name, 0.99),
+                     'mean': _histograms[name][1] / max(_histograms[name][2], 1)} for name in names}
+    result.update(counters)
+    result.update({name: func() for name, func in gauges.items()})
+    return result
+
+
+def export_text():
+    """Returns all metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for name, value in sorted(_counters.items()):
+            lines += ['# TYPE {} counter'.format(name), '{} {}'.format(name, value)]
+        for name, (counts, total, count) in sorted(_histograms.items()):
+            lines.append('# TYPE {}_seconds histogram'.format(name))
+            cumulative = 0
+            for bound, n in zip(BUCKETS, counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_seconds_bucket{{le="{}"}} {}'.format(name, le, cumulative))
+            lines += ['{}_seconds_sum {}'.format(name, total), '{}_seconds_count {}'.format(name, count)]
+        gauges = sorted(_gauges.items())
+    for name, func in gauges:
+        try:
+            lines += ['# TYPE {} gauge'.format(name), '{} {}'.format(name, float(func()))]
+        except Exception:
+            continue
+    return '\n'.join(lines) + '\n'
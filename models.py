@@ -0,0 +1,77 @@
+"""
+Registry of the pickled RandomForest alarm models in `processed_data`.
+"""
+import os
+import pickle
+import logging
+import threading
+
+import utils
+
+MODEL_DIR = 'processed_data'
+RATE_FILE = {1: '002', 2: '005', 3: '010'}
+CITIES = ['LA', 'ST']
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'model.log')
+
+_models = {}                             # (city, rate) -> (model, (mtime, size) of its file)
+_lock = threading.Lock()
+
+
+def model_path(city, arate):
+    """Returns the pickle file of the model for `city` and alarm rate `arate`"""
+    return os.path.join(MODEL_DIR, 'rf_' + RATE_FILE[arate] + '_' + city.lower() + '.pickle')
+
+
+def _load(fname, mmap_mode=None):
+    """Unpickles and validates the model in `fname`. With `mmap_mode` and joblib installed, the
+    numpy arrays of a joblib-dumped model are memory-mapped instead of read into memory.
+    """
+    if os.path.getsize(fname) == 0:
+        raise ValueError("empty model file {}".format(fname))
+    joblib = None
+    if mmap_mode is not None:
+        try:
+            import joblib                # ships with scikit-learn, but is optional here
+        except ImportError:
+            pass
+    if joblib is not None:
+        model = joblib.load(fname, mmap_mode=mmap_mode)
+    else:
+        with open(fname, 'rb') as f:
+            model = pickle.load(f)
+    if not callable(getattr(model, 'predict', None)):
+        raise ValueError("{} does not hold a fitted model".format(fname))
+    return model
+
+
+def get_model(city, arate, mmap_mode=None):
+    """Returns the model for `city` and `arate`, unpickled once per process. The file is stat'ed on
+    every call and reloaded when its modification time or size changed (hot reload); if a changed
+    file fails to load, the previously loaded model keeps being served until the file changes again.
+    """
+    fname = model_path(city, arate)
+    stat = os.stat(fname)
+    version = (stat.st_mtime, stat.st_size)
+    with _lock:
+        entry = _models.get((city, arate))
+        if entry is not None and entry[1] == version:
+            return entry[0]
+        try:
+            model = _load(fname, mmap_mode)
+        except Exception as e:
+            if entry is None:
+                raise
+            logger.warning("keeping previous model, cannot reload {}: {}".format(fname, e))
+            _models[(city, arate)] = (entry[0], version)     # do not retry until the file changes again
+            return entry[0]
+        _models[(city, arate)] = (model, version)
+        logger.info("loaded {}".format(fname))
+        return model
+
+
+def preload(mmap_mode=None):
+    """Loads every (city, rate) model up front, e.g. while a worker starts"""
+    for city in CITIES:
+        for arate in RATE_FILE:
+            get_model(city, arate, mmap_mode)
@@ -1,49 +1,255 @@
-from sklearn.neighbors import KernelDensity
-from datetime import datetime, date, timedelta
-from database import fetch_all_dis_as_df
+import os
+import copy
+from datetime import datetime, timedelta
+from cache import QueryCache
+from database import fetch_dis, fetch_wea_many, fetch_dis_daily
+from spatial import haversine_km
+from models import get_model, CITIES
+import metrics
 import pandas as pd
 import numpy as np
 
+LOCATIONS = {'la': (34, -118), 'st': (47, -122)}    # (lat, lon) of the alarm cities
+KDE_CACHE_SIZE = 8                                  # fitted models kept, keyed by bandwidth and data
+BANDWIDTHS = [0.2, 0.5, 1]                          # bandwidths of the three alarm rates
+GRID_DIR = 'processed_data'
+GRID_LAT = np.arange(25, 51, 1.0)                   # precomputed rate grid over the contiguous US
+GRID_LON = np.arange(-125, -65, 1.0)
+GRID_DAYS = 21
+RATE_BANDWIDTH = dict(zip([1, 2, 3], BANDWIDTHS))   # alarm rate -> KDE bandwidth
+PREDICT_JOBS = -1                                   # parallel trees per RandomForest predict of a large batch
+PREDICT_PARALLEL_ROWS = 1000                        # rows from which a RandomForest predict goes parallel
+BATCH_CACHE_SIZE = 16                               # batch predictions kept, keyed by their inputs
+
+_grids = {}                                         # path -> (mtime, loaded npz contents)
+
+# Entries are keyed by the data version, so they never expire; QueryCache makes them thread safe and
+# lets concurrent callbacks share one fit (single flight)
+_kde_cache = QueryCache(max_len=KDE_CACHE_SIZE, max_age_seconds=float('inf'), stale_seconds=0)
+_batch_cache = QueryCache(max_len=BATCH_CACHE_SIZE, max_age_seconds=float('inf'), stale_seconds=0)
+
+
+def _to_seconds(dates):
+    """Converts a sequence of dates/datetimes to float seconds in one vectorized call.
+    Data and query points go through the same conversion, so the normalization is consistent.
+    """
+    dt = pd.to_datetime(pd.Series(dates))
+    if dt.dt.tz is not None:
+        dt = dt.dt.tz_convert(None)
+    return (dt - pd.Timestamp(0)).dt.total_seconds().to_numpy()
+
 
 def norm_kde(df_wf,h):
-    mean_geo2 = np.mean(df_wf['geo2'])
-    mean_geo1 = np.mean(df_wf['geo1'])
-    mean_date = np.mean([datetime.fromisoformat(str(df_wf['datetime'].iloc[i])).timestamp() for i in range(len(df_wf))])
-
-    std_geo2 = np.std(df_wf['geo2'])
-    std_geo1 = np.std(df_wf['geo1'])
-    std_date = np.std([datetime.fromisoformat(str(df_wf['datetime'].iloc[i])).timestamp() for i in range(len(df_wf))])
-    X = np.array([ [ (df_wf['geo2'].iloc[i] - mean_geo2)/std_geo2,
-                    (df_wf['geo1'].iloc[i] - mean_geo1)/std_geo1,
-                    (datetime.fromisoformat(str(df_wf['datetime'].iloc[i])).timestamp()-mean_date)/std_date ] 
-                  for i in range(len(df_wf)) ])
-    kde = KernelDensity(kernel='gaussian', bandwidth=h).fit(X)
-    return kde,(mean_geo2,mean_geo1,mean_date,std_geo2,std_geo1,std_date)
+    """Fits the KDE on the standardized (lat, lon, seconds) of `df_wf`, each row weighted by its
+    `weight` column when there is one (e.g. the geometry count of a rollup row).
+    """
+    from sklearn.neighbors import KernelDensity      # sklearn takes over a second to import
+    X = np.column_stack([df_wf['geo2'].to_numpy(dtype=np.float64),
+                         df_wf['geo1'].to_numpy(dtype=np.float64),
+                         _to_seconds(df_wf['datetime'])])
+    w = df_wf['weight'].to_numpy(dtype=np.float64) if 'weight' in df_wf else None
+    mean = np.average(X, axis=0, weights=w)
+    std = np.sqrt(np.average((X - mean) ** 2, axis=0, weights=w))
+    kde = KernelDensity(kernel='gaussian', bandwidth=h).fit((X - mean) / std, sample_weight=w)
+    return kde,(mean[0],mean[1],mean[2],std[0],std[1],std[2])
+
 
 def kde_predict(x,kde):
-    a = (x[0]-kde[1][0])/kde[1][3]
-    b = (x[1]-kde[1][1])/kde[1][4]
-    c = (x[2]-kde[1][2])/kde[1][5]
-    return kde[0].score_samples([[a,b,c]])[0]
+    """Returns the log density of one point `x` = (lat, lon, seconds), or of every row when `x` is
+    a 2-d array, scored with a single `score_samples` call.
+    """
+    X = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    mean, std = np.array(kde[1][:3]), np.array(kde[1][3:])
+    scores = kde[0].score_samples((X - mean) / std)
+    return scores[0] if np.ndim(x) == 1 else scores
+
+
+def data_version(df_wf):
+    """Returns a cheap fingerprint of the wildfire rows the KDE is fitted on"""
+    cols = df_wf[[c for c in ['geo1', 'geo2', 'datetime', 'weight'] if c in df_wf]]
+    return len(cols), int(pd.util.hash_pandas_object(cols, index=False).sum())
+
+
+def fitted_kde(df_wf, h):
+    """Returns `norm_kde(df_wf, h)`, reusing the fit while the bandwidth and the wildfire rows
+    (hashed as the data version) stay the same.
+    """
+    return _kde_cache.get((h,) + data_version(df_wf), lambda: norm_kde(df_wf, h))
 
+
+@metrics.timed('kde')
 def kde(df,h,loc):
     df = df[df['title']=='Wildfires']
-    kde = norm_kde(df,h)
-    dates = []
-    for i in range(21):
-        d = datetime.now() - timedelta(days=i)
-        d = d.timetuple()
-        dates.append(date(d[0],d[1],d[2]))
-    if loc == 'la':
-        kde_pred = [kde_predict(
-                        [34,-118,datetime.fromisoformat(str(dates[i])).timestamp()]
-                       ,kde
-                      ) for i in range(len(dates))]
-    elif loc == 'st':
-        kde_pred = [kde_predict([47,-122,datetime.fromisoformat(str(dates[i])).timestamp()]
-                       ,kde
-                      ) for i in range(len(dates))]
-    return pd.DataFrame({'date':dates,'kde':kde_pred})
+    kde = fitted_kde(df, h)
+    dates = _days(21)
+    lat, lon = LOCATIONS[loc]
+    X = np.column_stack([np.full(len(dates), lat), np.full(len(dates), lon), _to_seconds(dates)])
+    return pd.DataFrame({'date':dates,'kde':kde_predict(X, kde)})
+
+
+def wildfire_points(allow_cached=True):
+    """Returns the wildfire history the KDE is fitted on, read from the `dis_daily` rollup: one row
+    per day and region cell with the cell centroid as `geo1`/`geo2`, the day as `datetime` and the
+    geometry count as `weight`. Falls back to the raw rows while the rollup is empty.
+    """
+    df = fetch_dis_daily(title='Wildfires')
+    if df is not None:
+        return df.rename(columns={'day': 'datetime', 'count': 'weight'})[
+            ['title', 'geo1', 'geo2', 'datetime', 'weight']]
+    return fetch_dis(title='Wildfires', fields=['title', 'geo1', 'geo2', 'datetime'], allow_cached=allow_cached)
+
+
+def _days(n):
+    """Returns the last `n` dates, today first, as `kde` reports them"""
+    today = datetime.now().date()
+    return [today - timedelta(days=i) for i in range(n)]
+
+
+def rate_grid_path(h):
+    return os.path.join(GRID_DIR, 'kde_grid_{}.npz'.format(h))
+
+
+def build_rate_grid(df, h, lats=GRID_LAT, lons=GRID_LON, days=GRID_DAYS):
+    """Evaluates the wildfire KDE of bandwidth `h` on every (date, lat, lon) of the grid with one
+    `score_samples` call and returns (dates, log density array of shape (days, lats, lons)).
+    """
+    kde = fitted_kde(df[df['title']=='Wildfires'], h)
+    dates = _days(days)
+    t, la, lo = np.meshgrid(_to_seconds(dates), lats, lons, indexing='ij')
+    X = np.column_stack([la.ravel(), lo.ravel(), t.ravel()])
+    return dates, kde_predict(X, kde).reshape(t.shape).astype(np.float32)
+
+
+@metrics.timed('update_rate_grids')
+def update_rate_grids(df=None, bandwidths=BANDWIDTHS, lats=GRID_LAT, lons=GRID_LON, days=GRID_DAYS):
+    """Periodic job: rebuilds and saves the rate grid of every bandwidth over `lats` x `lons` and
+    the last `days` days from the wildfire history (`wildfire_points`). A grid already built today
+    from the same rows over the same axes is left alone.
+    """
+    if df is None:
+        df = wildfire_points(allow_cached=False)
+    if df is None:
+        return
+    version = np.array(data_version(df[df['title']=='Wildfires']), dtype=np.uint64)
+    for h in bandwidths:
+        grid = _load_grid(h)
+        if grid is not None and np.array_equal(grid['version'], version) and \
+                grid['dates'][0] == np.datetime64(datetime.now().date(), 'D') and len(grid['dates']) == days and \
+                np.array_equal(grid['lats'], lats) and np.array_equal(grid['lons'], lons):
+            continue                                    # built today from the same rows and axes
+        dates, kde = build_rate_grid(df, h, lats, lons, days)
+        path = rate_grid_path(h)
+        with open(path + '.tmp', 'wb') as f:            # write aside, then swap in atomically
+            np.savez(f, dates=np.array(dates, dtype='datetime64[D]'), lats=np.asarray(lats, dtype=np.float64),
+                     lons=np.asarray(lons, dtype=np.float64), kde=kde, version=version)
+        os.replace(path + '.tmp', path)
+
+
+def _load_grid(h):
+    path = rate_grid_path(h)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+    if path not in _grids or _grids[path][0] != mtime:
+        with np.load(path) as npz:
+            _grids[path] = (mtime, {k: npz[k] for k in npz.files})
+    return _grids[path][1]
+
+
+def _axis_weights(axis, v):
+    """Returns the two neighbouring indices of `v` on the ascending `axis` and the weight of the
+    upper one; `v` must lie within the axis range.
+    """
+    pos = float(np.interp(v, axis, np.arange(len(axis))))
+    i0 = int(np.floor(pos))
+    return i0, min(i0 + 1, len(axis) - 1), pos - i0
+
+
+def lookup_rate(lat, lon, h):
+    """Returns the same table as `kde` for any (lat, lon) inside the precomputed grid of bandwidth
+    `h`, bilinearly interpolated. Returns None when no grid was built today or (lat, lon) lies
+    outside of it, so that callers fit the KDE instead.
+    """
+    grid = _load_grid(h)
+    if grid is None or grid['dates'][0] != np.datetime64(datetime.now().date(), 'D'):
+        return None
+    if not (grid['lats'][0] <= lat <= grid['lats'][-1] and grid['lons'][0] <= lon <= grid['lons'][-1]):
+        return None
+    i0, i1, wy = _axis_weights(grid['lats'], lat)
+    j0, j1, wx = _axis_weights(grid['lons'], lon)
+    g = grid['kde']
+    pred = (1-wy) * ((1-wx) * g[:, i0, j0] + wx * g[:, i0, j1]) + wy * ((1-wx) * g[:, i1, j0] + wx * g[:, i1, j1])
+    return pd.DataFrame({'date': list(grid['dates'].astype(object)), 'kde': pred.astype(np.float64)})
+
+
+def _with_jobs(model, n_jobs):
+    """Returns `model` predicting on `n_jobs` cores. The registry's model is shared by every caller,
+    so a shallow copy (sharing the fitted trees) gets the setting instead of the model itself.
+    """
+    current = getattr(model, 'n_jobs', n_jobs)
+    if current == n_jobs or current is None and n_jobs == 1:      # scikit-learn runs n_jobs=None on one core
+        return model
+    model = copy.copy(model)
+    model.n_jobs = n_jobs
+    return model
+
+
+def nearest_city(lats, lons):
+    """Returns, for every (lat, lon), the city in `models.CITIES` whose model is the closest"""
+    dist = np.column_stack([haversine_km(*LOCATIONS[c.lower()], np.asarray(lats), np.asarray(lons))
+                            for c in CITIES])
+    return np.asarray(CITIES)[dist.argmin(axis=1)]
+
+
+@metrics.timed('predict_batch')
+def predict_batch(locations, since=None, until=None, rates=(1, 2, 3), n_jobs=PREDICT_JOBS, allow_cached=True,
+                  with_kde=True):
+    """Scores every (lat, lon) in `locations` on each day of stored weather with `since` < date
+    <= `until` (by default from yesterday on, i.e. the forecast), for every alarm rate in `rates`.
+
+    The weather of all locations is fetched with one query and stacked into one feature matrix;
+    each RandomForest (that of the nearest city, see `nearest_city`) predicts its rows with one
+    call, on `n_jobs` cores from `PREDICT_PARALLEL_ROWS` rows on and on one core below, and the
+    KDE of each rate scores all rows with one call. Returns a `DataFrame` with one row per
+    location, date and rate: `lat`, `lon`, `date`, `rate`, `city`, `rf` and `kde` (both log rates),
+    or None without weather. Without `with_kde` the wildfire rows are not read and `kde` is NaN.
+    Results are cached until the weather or the wildfire rows change; without `allow_cached` the
+    inputs are read uncached.
+    """
+    if since is None:
+        since = datetime.now() - timedelta(days=1)
+    wea = fetch_wea_many(locations, since=since, until=until, allow_cached=allow_cached)
+    if wea is None:
+        return None
+    wea = wea.sort_values(by=['lat', 'long', 'date'], ignore_index=True)
+    fires = wildfire_points(allow_cached) if with_kde else None
+    key = (tuple(rates), with_kde, len(wea), int(pd.util.hash_pandas_object(wea, index=False).sum()),
+           None if fires is None else data_version(fires))
+
+    def _work():
+        features = sorted(c for c in wea.columns if c not in ('date', 'observed'))  # WEATHER_SCHEMA order
+        X = wea[features].to_numpy(dtype=np.float64)
+        cities = nearest_city(wea['lat'], wea['long'])
+        points = np.column_stack([wea['lat'], wea['long'], _to_seconds(wea['date'])])
+        tables = []
+        for rate in rates:
+            rf = np.full(len(wea), np.nan)
+            for city in np.unique(cities):
+                rows = cities == city
+                jobs = n_jobs if rows.sum() >= PREDICT_PARALLEL_ROWS else 1
+                model = _with_jobs(get_model(str(city), rate), jobs)
+                rf[rows] = model.predict(X[rows])
+            if fires is None:
+                dens = np.full(len(wea), np.nan)
+            else:
+                dens = kde_predict(points, fitted_kde(fires, RATE_BANDWIDTH[rate]))
+            tables.append(pd.DataFrame({'lat': wea['lat'], 'lon': wea['long'], 'date': wea['date'],
+                                        'rate': rate, 'city': cities, 'rf': rf, 'kde': dens}))
+        return pd.concat(tables, ignore_index=True)
+
+    return _batch_cache.get(key, _work).copy()
+
 
 if __name__=='__main__':
-    print(kde(fetch_all_dis_as_df(), 0.1, "la"))
\ No newline at end of file
+    print(kde(fetch_dis(title='Wildfires'), 0.1, "la"))
@@ -0,0 +1,105 @@
+"""
+Periodic job scheduler running the acquisition jobs of `data_acquire.py` concurrently.
+"""
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'data.log')
+
+
+class JobScheduler:
+    """Runs named jobs on a worker pool, each on its own interval.
+
+    A job is never started again while its previous run is still going (overlap prevention); the
+    next run is due `interval` seconds plus up to `jitter` seconds after the previous one finished.
+    A job registered with `after` also runs each time one of those jobs completes without an
+    error; triggers that arrive while it is running or already due are coalesced into one run.
+    Python threads cannot be interrupted, so a run exceeding its `timeout` is reported as
+    `timeout` in `status()` and logged, while the job stays blocked until the run returns.
+    """
+
+    def __init__(self, max_workers=4):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def add_job(self, name, func, interval=None, timeout=None, jitter=0.0, delay=0.0, after=()):
+        """Registers `func` to run every `interval` seconds, first after `delay` seconds, and after
+        every successful run of the jobs named in `after`. A job without `interval` runs once, or
+        with `after` only when triggered.
+        """
+        next_run = None if interval is None and after else time.time() + delay
+        with self._lock:
+            self._jobs[name] = {'func': func, 'interval': interval, 'timeout': timeout,
+                                'jitter': jitter, 'next_run': next_run, 'after': set(after),
+                                'triggered': False, 'running_since': None, 'timed_out': False, 'last_start': None,
+                                'last_duration': None, 'last_outcome': None, 'runs': 0, 'failures': 0}
+
+    def _run(self, name):
+        job = self._jobs[name]
+        start = time.time()
+        try:
+            job['func']()
+            outcome = 'ok'
+        except Exception as e:
+            outcome = 'error: {}'.format(e)
+            logger.warning("job {} failed: {}".format(name, e))
+        with self._lock:
+            duration = time.time() - start
+            job.update(running_since=None, last_duration=duration, runs=job['runs'] + 1)
+            if outcome == 'ok' and job['timed_out']:
+                outcome = 'timeout'
+            if outcome != 'ok':
+                job['failures'] += 1
+            job['last_outcome'] = outcome
+            if job['interval'] is not None:
+                job['next_run'] = time.time() + job['interval'] + random.uniform(0, job['jitter'])
+            if not outcome.startswith('error'):      # a slow run still produced new data
+                for other in self._jobs.values():
+                    if name in other['after']:
+                        other['triggered'] = True
+        logger.info("job={}, duration={:.2f}, outcome={}".format(name, duration, outcome))
+
+    def run_pending(self):
+        """Starts every due job that is not already running, flags overrunning jobs and returns the
+        seconds until the next job is due.
+        """
+        now = time.time()
+        with self._lock:
+            for name, job in self._jobs.items():
+                if job['running_since'] is not None:
+                    if job['timeout'] and not job['timed_out'] and now - job['running_since'] > job['timeout']:
+                        job['timed_out'] = True
+                        logger.warning("job {} exceeded its {}s timeout".format(name, job['timeout']))
+                    continue
+                if job['triggered'] or job['next_run'] is not None and job['next_run'] <= now:
+                    job.update(running_since=now, last_start=now, timed_out=False, triggered=False)
+                    if job['interval'] is None:
+                        job['next_run'] = None
+                    self._pool.submit(self._run, name)
+            due = [now if job['triggered'] else job['next_run'] for job in self._jobs.values()
+                   if (job['triggered'] or job['next_run'] is not None) and job['running_since'] is None]
+        return max(0.0, min(due) - now) if due else float('inf')
+
+    def run(self, poll=1.0):
+        """Blocks running jobs until `stop` is called; overruns are checked every `poll` seconds"""
+        while not self._stop.is_set():
+            self._stop.wait(min(self.run_pending(), poll))
+
+    def stop(self, wait=False):
+        self._stop.set()
+        self._pool.shutdown(wait=wait)
+
+    def status(self):
+        """Returns the last start, duration and outcome and the run/failure counts of every job"""
+        keys = ['last_start', 'last_duration', 'last_outcome', 'runs', 'failures', 'next_run']
+        with self._lock:
+            return {name: dict({k: job[k] for k in keys}, running=job['running_since'] is not None)
+                    for name, job in self._jobs.items()}
@@ -0,0 +1,121 @@
+"""
+Versioned columnar snapshot of the `disasters` collection. The ingester publishes it as NumPy
+`.npy` files after each update; dashboard processes memory-map the current version, so all
+workers share one copy of the working set through the page cache instead of each re-querying
+and re-materialising the collection.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+import utils
+from database import fetch_dis
+
+SNAPSHOT_DIR = os.path.join('processed_data', 'snapshot')
+SNAPSHOT_KEEP = 3                # versions kept on disk, so readers of an older one are not cut off
+SNAPSHOT_MAX_AGE = 900           # seconds after which readers ignore a snapshot and query MongoDB
+NUMERIC = {'datetime': 'datetime64[ns]', 'geo1': 'float64', 'geo2': 'float64'}
+CATEGORICAL = ['title', 'status', 'subid', 'subtitle']
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'db.log')
+
+_loaded = (None, None, None)     # (version, {column: memory-mapped array}, meta)
+_lock = threading.Lock()
+
+
+def publish_snapshot(df=None):
+    """Writes `df` (by default the whole `disasters` collection) as a new snapshot version:
+    one `.npy` file per column, with categorical columns stored as int32 codes plus their
+    categories and the publish time in `meta.json`. The `CURRENT` pointer is swapped atomically once all files exist.
+    Returns the new version, or None if there is nothing to publish.
+    """
+    if df is None:
+        df = fetch_dis(fields=list(NUMERIC) + CATEGORICAL)
+    if df is None:
+        return None
+    version = 'v{}'.format(time.time_ns())
+    path = os.path.join(SNAPSHOT_DIR, version)
+    os.makedirs(path)
+    meta = {'rows': len(df), 'published': time.time(), 'categories': {}}
+    for col, dtype in NUMERIC.items():
+        values = df[col]
+        if dtype.startswith('datetime64'):
+            values = pd.to_datetime(values, utc=True).dt.tz_convert(None)
+        np.save(os.path.join(path, col + '.npy'), values.to_numpy(dtype=dtype))
+    for col in CATEGORICAL:
+        cat = pd.Categorical(df[col].astype(str))
+        meta['categories'][col] = list(cat.categories)
+        np.save(os.path.join(path, col + '.npy'), cat.codes.astype(np.int32))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    pointer = os.path.join(SNAPSHOT_DIR, 'CURRENT')
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(pointer + '.tmp', pointer)
+    for old in sorted(d for d in os.listdir(SNAPSHOT_DIR) if d.startswith('v'))[:-SNAPSHOT_KEEP]:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, old), ignore_errors=True)
+    logger.info("version={}, rows={}".format(version, len(df)))
+    return version
+
+
+def _current():
+    """Returns (version, columns, meta) of the current snapshot, memory-mapping it when the
+    version changed since the last call, or (None, None, None) if none was published.
+    """
+    global _loaded
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, 'CURRENT')) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None, None, None
+    with _lock:
+        if _loaded[0] != version:
+            path = os.path.join(SNAPSHOT_DIR, version)
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            columns = {col: np.load(os.path.join(path, col + '.npy'), mmap_mode='r')
+                       for col in list(NUMERIC) + CATEGORICAL}
+            _loaded = (version, columns, meta)
+        return _loaded
+
+
+def snapshot_dis(title=None, status=None, since=None, fields=None, max_age=SNAPSHOT_MAX_AGE):
+    """Returns the disasters of the current snapshot matching the filters of `database.fetch_dis`
+    (without `bbox`) as a `DataFrame`; only the selected rows are copied out of the mapped files.
+    Returns None when no snapshot was published in the last `max_age` seconds, e.g. because the
+    ingester stalled, so that callers fall back to MongoDB, or when nothing matched.
+    """
+    version, columns, meta = _current()
+    if version is None or time.time() - meta.get('published', 0) > max_age:
+        return None
+    categories = meta['categories']
+    mask = np.ones(len(columns['geo1']), dtype=bool)
+    for col, wanted in [('title', title), ('status', status)]:
+        if wanted is None:
+            continue
+        wanted = [wanted] if isinstance(wanted, str) else list(wanted)
+        codes = [categories[col].index(w) for w in wanted if w in categories[col]]
+        mask &= np.isin(columns[col], codes)
+    if since is not None:
+        since = pd.Timestamp(since)
+        if since.tz is not None:
+            since = since.tz_convert(None)
+        mask &= columns['datetime'] > since.to_datetime64()
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return None
+    fields = fields or list(NUMERIC) + CATEGORICAL
+    data = {}
+    for col in fields:
+        if col in CATEGORICAL:
+            data[col] = pd.Categorical.from_codes(columns[col][rows], categories[col])
+        else:
+            data[col] = columns[col][rows]
+    return pd.DataFrame(data)
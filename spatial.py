@@ -0,0 +1,64 @@
+"""
+In-process spatial index over disaster coordinates.
+"""
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat, lon, lats, lons):
+    """Returns the great-circle distances in km from (`lat`, `lon`) to the arrays `lats`, `lons`"""
+    p1, p2 = np.radians(lat), np.radians(lats)
+    dp, dl = p2 - p1, np.radians(lons) - np.radians(lon)
+    a = np.sin(dp / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class GridIndex:
+    """Buckets points into `cell_deg` x `cell_deg` cells so radius and bounding-box queries only
+    look at the points of the cells they overlap. Queries return positional indices into the
+    `lats`/`lons` arrays the index was built from.
+    """
+
+    def __init__(self, lats, lons, cell_deg=1.0):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_deg = cell_deg
+        rows, cols = self._cell(self.lats, self.lons)
+        order = np.lexsort((cols, rows))
+        keys = np.stack([rows[order], cols[order]], axis=1)
+        starts = np.flatnonzero(np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)])
+        bounds = np.r_[starts, len(order)]
+        self._cells = {tuple(keys[s]): order[s:e] for s, e in zip(bounds[:-1], bounds[1:])}
+
+    def _cell(self, lats, lons):
+        return (np.floor(np.asarray(lats) / self.cell_deg).astype(np.int64),
+                np.floor(np.asarray(lons) / self.cell_deg).astype(np.int64))
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon):
+        (r0, r1), (c0, c1) = self._cell([min_lat, max_lat], [min_lon, max_lon])
+        if (r1 - r0 + 1) * (c1 - c0 + 1) > len(self._cells):
+            found = [idx for (r, c), idx in self._cells.items() if r0 <= r <= r1 and c0 <= c <= c1]
+        else:
+            found = [self._cells[(r, c)] for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)
+                     if (r, c) in self._cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def within_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Returns the indices of the points inside the box, sorted"""
+        idx = self._candidates(min_lat, min_lon, max_lat, max_lon)
+        keep = (self.lats[idx] >= min_lat) & (self.lats[idx] <= max_lat) & \
+               (self.lons[idx] >= min_lon) & (self.lons[idx] <= max_lon)
+        return np.sort(idx[keep])
+
+    def within_radius(self, lat, lon, radius_km):
+        """Returns the indices of the points within `radius_km` of (`lat`, `lon`), sorted"""
+        dlat = radius_km / KM_PER_DEGREE
+        coslat = np.cos(np.radians(min(abs(lat) + dlat, 90.0)))
+        dlon = 180.0 if coslat < 1e-6 else min(radius_km / (KM_PER_DEGREE * coslat), 180.0)
+        idx = self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        if lon - dlon < -180 or lon + dlon > 180:        # the circle wraps around the antimeridian
+            idx = np.arange(len(self.lats))
+        keep = haversine_km(lat, lon, self.lats[idx], self.lons[idx]) <= radius_km
+        return np.sort(idx[keep])
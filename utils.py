@@ -1,17 +1,39 @@
 import sys
+import time
 import logging
 
+_handlers = {}                  # output file (None for stdout) -> handler shared by all loggers
 
-def setup_logger(logger, output_file):
-    logger.setLevel(logging.INFO)
 
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setFormatter(logging.Formatter('%(asctime)s [%(funcName)s]: %(message)s'))
-    logger.addHandler(stdout_handler)
+def _handler(output_file):
+    """Returns the one handler writing to `output_file`, or to stdout when None. File handlers
+    open their file on the first record, so importing a module does not touch the disk.
+    """
+    if output_file not in _handlers:
+        if output_file is None:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter('%(asctime)s [%(funcName)s]: %(message)s'))
+        else:
+            handler = logging.FileHandler(output_file, delay=True)
+            handler.setFormatter(logging.Formatter('%(asctime)s [%(funcName)s] %(message)s'))
+        _handlers[output_file] = handler
+    return _handlers[output_file]
 
-    file_handler = logging.FileHandler(output_file)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s [%(funcName)s] %(message)s'))
-    logger.addHandler(file_handler)
 
+def setup_logger(logger, output_file):
+    logger.setLevel(logging.INFO)
+    for handler in [_handler(None), _handler(output_file)]:
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
 
 
+def log_import_time(logger, module, start, budget):
+    """Logs the seconds spent importing `module` since `start` (a `time.perf_counter()` value),
+    as a warning when they exceed `budget`. Returns the elapsed seconds.
+    """
+    elapsed = time.perf_counter() - start
+    if elapsed > budget:
+        logger.warning("importing {} took {:.2f}s, over the {:.2f}s budget".format(module, elapsed, budget))
+    else:
+        logger.info("imported {} in {:.2f}s".format(module, elapsed))
+    return elapsed
@@ -1,57 +1,98 @@
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
 
 from datetime import datetime, timedelta
-from database import fetch_all_wea_as_df, fetch_all_dis_as_df
+from database import fetch_wea, fetch_dis, dis_within_bbox
 from plotly.subplots import make_subplots
-from sklearn.ensemble import RandomForestRegressor
-from prediction import kde as kde_func
+from prediction import kde as kde_func, lookup_rate, predict_batch, wildfire_points, LOCATIONS
 import numpy as np
 
-import pickle
+from snapshot import snapshot_dis
 
-def alarm_predict(city='LA', arate=1):
-    rate_d = {1:'002', 2:'005', 3:'010'}
-    fname = 'processed_data/rf_'+rate_d[arate]+'_'+city.lower()+'.pickle'
-    reg = pickle.load(open(fname, 'rb'))
+CITY_LAT = {'LA': 34, 'ST': 47}
+MAP_MAX_MARKERS = 2000          # points shipped to the browser before aggregating
+MAP_CELL_DEG = 8.0              # aggregation cell at zoom level 0, in degrees
+MAP_DEFAULT_ZOOM = 2
+MAP_VIEWPORT_ZOOM = 3           # from this zoom on only the viewport is plotted, at a finer cell
+MAP_VIEWPORT_MARGIN = 0.5       # share of the viewport span added on each side, so short pans stay covered
+
+def alarm_predict(city='LA', arate=1, allow_cached=True):
     if city not in ['LA', 'ST']:
         return None
-    dfx = fetch_all_wea_as_df()
-    dfx = dfx[dfx['date']>datetime.now()-timedelta(days=1)].sort_values(by='date')
-    if city=='LA':
-        dfx = dfx[dfx['lat']==34]
-    else:
-        dfx = dfx[dfx['lat']==47]
-    X_test = dfx.drop('date',1).values
+    df = predict_batch([LOCATIONS[city.lower()]], rates=[arate], allow_cached=allow_cached, with_kde=False)
+    return df['date'], df['rf'].to_numpy()
+
+def aggregate_points(df, max_markers=MAP_MAX_MARKERS, zoom=MAP_DEFAULT_ZOOM):
+    """Bins the points of `df` into lat/lon cells, separately per status, and returns one row per
+    non-empty cell with the mean `geo1`/`geo2`, the point `count` and the `status`. The cell starts
+    at MAP_CELL_DEG degrees at zoom 0, halves with each zoom level and doubles until no more than
+    `max_markers` cells remain.
+    """
+    cell = MAP_CELL_DEG / 2 ** zoom
+    while True:
+        binned = df.assign(_r=(df['geo2'] // cell).astype('int64'), _c=(df['geo1'] // cell).astype('int64'))
+        agg = binned.groupby(['status', '_r', '_c'], observed=True).agg(
+            geo1=('geo1', 'mean'), geo2=('geo2', 'mean'), count=('geo1', 'size')).reset_index()
+        if len(agg) <= max_markers or cell >= 180:
+            return agg.drop(columns=['_r', '_c'])
+        cell *= 2
+
+
+def map_viewport(relayout):
+    """Returns the map view of the disaster map's `relayoutData` as a dict with its `zoom` and the
+    `bbox` (min_lon, min_lat, max_lon, max_lat) it shows, widened by `MAP_VIEWPORT_MARGIN`.
+    Returns None for the world view: below `MAP_VIEWPORT_ZOOM`, when the map did not report its
+    corners or when the viewport crosses the antimeridian.
+    """
+    relayout = relayout or {}
+    zoom = relayout.get('mapbox.zoom')
+    corners = (relayout.get('mapbox._derived') or {}).get('coordinates')
+    if zoom is None or zoom < MAP_VIEWPORT_ZOOM or not corners:
+        return None
+    lons, lats = [c[0] for c in corners], [c[1] for c in corners]
+    if min(lons) < -180 or max(lons) > 180:
+        return None
+    dlon, dlat = (max(lons) - min(lons)) * MAP_VIEWPORT_MARGIN, (max(lats) - min(lats)) * MAP_VIEWPORT_MARGIN
+    bbox = [max(-180.0, min(lons) - dlon), max(-90.0, min(lats) - dlat),
+            min(180.0, max(lons) + dlon), min(90.0, max(lats) + dlat)]
+    return {'zoom': zoom, 'bbox': [round(v, 4) for v in bbox]}
 
-    return dfx['date'], reg.predict(X_test)
 
-def map_plot(df):
+def map_plot(df, max_markers=MAP_MAX_MARKERS, zoom=MAP_DEFAULT_ZOOM):
+    """Plots the disasters of the last 365 days. When there are more than `max_markers` points they
+    are aggregated server side (`aggregate_points`) and the marker size grows with the count.
+    """
     fig = go.Figure()
     dt_now = datetime.now()
     dt_last = dt_now - timedelta(days=365)
     df = df[df['datetime']>dt_last]
+    if len(df) > max_markers:
+        df = aggregate_points(df, max_markers, zoom)
+        size = lambda d, base: base + 3 * np.log2(d['count'])
+        text = lambda d, s: ['{} disasters {}'.format(c, s) for c in d['count']]
+    else:
+        size = lambda d, base: base
+        text = lambda d, s: ['disaster ' + s]
     df1, df2 = df[df['status']=='open'], df[df['status']=='closed']
     fig.add_trace(go.Scattermapbox(
             lat=df2["geo2"], lon=df2["geo1"],
             mode='markers',
             marker=go.scattermapbox.Marker(
-                size=10,
+                size=size(df2, 10),
                 opacity=0.5,
                 color='rgb(64, 224, 178)'
             ),
-            text=['disaster closed'],
+            text=text(df2, 'closed'),
     ))
     fig.add_trace(go.Scattermapbox(
             lat=df1["geo2"], lon=df1["geo1"],
             mode='markers',
             marker=go.scattermapbox.Marker(
-                size=11,
+                size=size(df1, 11),
                 opacity=0.8,
                 color='rgb(255, 127, 80)'
             ),
-            text=['disaster open'],
+            text=text(df1, 'open'),
     ))
 
     fig.update_layout(
@@ -68,29 +109,51 @@ def map_plot(df):
             ]},
         ])
     fig.update_layout(template='plotly_dark', 
-                      margin={"r":0,"t":0,"l":0,"b":0})
+                      margin={"r":0,"t":0,"l":0,"b":0},
+                      uirevision='map')     # keep the user's pan and zoom when the figure is replaced
     return fig
 
 
-def alarm_visualization(city, rate):
-    """Changes the display graph of supply-demand"""
+def disaster_visualization(status, disaster, allow_cached=True, viewport=None):
+    """Returns the map of the `disaster` kind with the given statuses of the last 365 days.
+    With a `viewport` from `map_viewport`, only the disasters inside its box are plotted and
+    aggregated from its zoom, so zooming in gains resolution. Without `allow_cached` the data is
+    read fresh, as the ingester does when precomputing the world view.
+    """
+    if viewport is not None:
+        df, zoom = dis_within_bbox(viewport['bbox'], days=365, title=disaster, status=status), viewport['zoom']
+    else:
+        query = dict(title=disaster, status=status, since=datetime.now()-timedelta(days=365),
+                     fields=['geo1', 'geo2', 'datetime', 'status'])
+        df, zoom = snapshot_dis(**query), MAP_DEFAULT_ZOOM
+        if df is None:
+            df = fetch_dis(allow_cached=allow_cached, **query)
+    if df is None:                  # nothing selected: keep the empty map rather than a blank figure
+        df = pd.DataFrame({'geo1': pd.Series(dtype='float64'), 'geo2': pd.Series(dtype='float64'),
+                           'datetime': pd.Series(dtype='datetime64[ns]'), 'status': pd.Series(dtype=object)})
+    return map_plot(df, zoom=zoom)
+
+
+def alarm_visualization(city, rate, allow_cached=True):
+    """Changes the display graph of supply-demand, see `disaster_visualization` for `allow_cached`"""
     if city not in ['LA','ST']:
         return go.Figure()
-    df = fetch_all_wea_as_df(allow_cached=True)
-    df = df[df['date']>datetime.now()-timedelta(days=21)].sort_values(by=['date'])
-    if city == 'LA':
-        df_u = df[df['lat']==34]
-    elif city == 'ST':
-        df_u = df[df['lat']==47]
+    df_u = fetch_wea(lat=CITY_LAT[city], since=datetime.now()-timedelta(days=21), allow_cached=allow_cached)
+    if df_u is None:
+        return go.Figure()
+    df_u = df_u.sort_values(by=['date'])
     fig = make_subplots(specs=[[{"secondary_y": True}]])
 
     fig.add_trace(go.Scatter(x=df_u['date'], y=df_u['temperatureHigh'], mode='lines', name='High Temperature',
                              line={'width': 2, 'color': 'orange'}), secondary_y=False)
 
     try:                         
-        d2, y2 = alarm_predict(city, rate)
+        d2, y2 = alarm_predict(city, rate, allow_cached)
         rate_f = {1:0.2, 2: 0.5, 3:1}
-        dfkde = kde_func(fetch_all_dis_as_df(), rate_f[rate], city.lower()).sort_values(by='date')
+        dfkde = lookup_rate(*LOCATIONS[city.lower()], rate_f[rate])
+        if dfkde is None:           # no grid today: fit on the same rollup rows as the grids
+            dfkde = kde_func(wildfire_points(allow_cached), rate_f[rate], city.lower())
+        dfkde = dfkde.sort_values(by='date')
         # print(dfkde)
         fig.add_trace(go.Scatter(x=dfkde['date'], y=np.exp(dfkde['kde']), mode='lines', name='Real WildFire Rate', 
                                 fill='tozeroy', line={'width': 2, 'color': 'pink'}, stackgroup='stack'), secondary_y=True)